@@ -9,7 +9,7 @@ __author__ = 'milletluo'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 # page对象,用于储存分页信息
 class Page(object):
@@ -46,6 +46,71 @@ class Page(object):
 
     __repr__ = __str__
 
+# 游标是不透明的字符串，内容为方向('n'下一页/'p'上一页)加上边界行的(created_at, id)
+def encode_cursor(direction, key):
+    s = json.dumps([direction] + list(key), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 解析游标，格式不对时当作第一页处理，返回(direction, key)
+def decode_cursor(cursor):
+    if not cursor:
+        return None, None
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, created_at, id = json.loads(s)
+        if direction in ('n', 'p'):
+            return direction, (created_at, id)
+    except (ValueError, TypeError):
+        pass
+    logging.info('invalid cursor: %s' % cursor)
+    return None, None
+
+# keyset分页对象，页码被next_cursor/prev_cursor取代，翻页不再依赖offset
+class CursorPage(object):
+    '''Page object for keyset pagination.'''
+
+    def __init__(self, item_count, cursor=None, page_size=10):
+        '''init Pagination by item_count, cursor, page_size
+        item_count - 博客总数，只用于显示
+        cursor - 上一次返回的next_cursor或prev_cursor，None或空串表示第一页
+        page_size - 一个页面最多显示博客的数目'''
+        self.item_count = item_count
+        self.page_size = page_size
+        self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+        direction, key = decode_cursor(cursor)
+        # after、before直接传给Model.findAll()，多取一行用来判断前面或后面是否还有数据
+        self.after = key if direction == 'n' else None
+        self.before = key if direction == 'p' else None
+        self.limit = page_size + 1
+        self.has_next = False
+        self.has_previous = False
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    def paginate(self, items):
+        '''根据查询结果(已按created_at倒序)设置游标，返回本页要显示的items'''
+        more = len(items) > self.page_size
+        if self.before is not None:
+            # before查询多出的那一行在最前面
+            items = items[1:] if more else items
+            self.has_previous, self.has_next = more, True
+        else:
+            items = items[:self.page_size]
+            self.has_previous, self.has_next = self.after is not None, more
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('n', (items[-1].created_at, items[-1].id))
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('p', (items[0].created_at, items[0].id))
+        else:
+            self.has_next = self.has_previous = False
+        return items
+
+    def __str__(self):
+        return 'item_count: %s, page_size: %s, after: %s, before: %s' % (self.item_count, self.page_size, self.after, self.before)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
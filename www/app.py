@@ -13,7 +13,7 @@ async web application.
 # 日志级别大小关系为：CRITICAL > ERROR > WARNING > INFO > DEBUG > NOTSET
 import logging; logging.basicConfig(level=logging.INFO)
 # json模块提供了Python对象到Json模块的转换
-import asyncio, os, json, time
+import asyncio, os, json, time, signal
 from datetime import datetime
 from aiohttp import web
 
@@ -21,6 +21,8 @@ from aiohttp import web
 # Environment指的是jinjia2模板的配置环境，FileSystemLoader是文件系统加载器，用来加载模板路径
 from jinja2 import Environment, FileSystemLoader
 import orm
+from config import configs
+from models import User, Blog, Comment
 from coroweb import add_routes, add_static
 from handlers import cookie2user, COOKIE_NAME
 
@@ -75,6 +77,19 @@ async def logger_factory(app, handler):
         return (await handler(request))
     return logger
 
+# 统计每个请求发到数据库的语句数和耗时，同一条语句重复执行多次(N+1查询)时输出警告
+# debug模式下把统计结果放到响应头X-DB-Queries里
+async def query_count_factory(app, handler):
+    async def query_count(request):
+        counter = orm.track_queries()
+        r = await handler(request)
+        for sql, n in counter.repeated(configs.db.get('repeated_query_warn', 3)).items():
+            logging.warning('N+1 query? %s executed %s times in %s %s' % (sql, n, request.method, request.path))
+        if configs.debug and isinstance(r, web.StreamResponse) and not r.prepared:
+            r.headers['X-DB-Queries'] = '%s; time=%.1fms' % (counter.count, counter.time * 1000)
+        return r
+    return query_count
+
 # 这个函数在day10中定义
 # 这个middlewares的作用是在处理请求之前，先将cookie解析出来，并将登陆用户绑定到request对象上
 # 以后的每个请求，都是在这个middle之后处理的，都已经绑定了用户信息
@@ -107,6 +122,12 @@ async def data_factory(app, handler):
         return (await handler(request))
     return parse_data
 
+# json.dumps无法直接序列化的对象：orm的Record用to_dict()，其他对象(如Page)用__dict__
+def json_default(o):
+    if isinstance(o, orm.Record):
+        return o.to_dict()
+    return o.__dict__
+
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
@@ -135,7 +156,7 @@ async def response_factory(app, handler):
             template = r.get('__template__')
             # 若不存在对应模板，则将字典调整为json格式返回，并设置响应类型为json
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -192,11 +213,20 @@ async def init(loop):
 	#将处理函数注册到app.router中，这里应该就是说把index函数注册为request '/' 的处理函数
     #app.router.add_route('GET','/',index)
 
+    # 主键生成器的worker id
+    orm.configure_ids(**configs.ids)
     # 创建数据库连接池
-    await orm.create_pool (loop = loop, host = '127.0.0.1', port = 3306, user='www-data', password='www-data', db = 'awesome')
+    # 创建数据库连接池，参数(包括只读副本)来自配置文件的db部分
+    await orm.create_pool (loop = loop, **configs.db)
+    # 按models里的定义建表，已存在的表不变；使用SQLite时不需要先执行schema.sql
+    if configs.db.get('create_tables', False):
+        await orm.create_tables(User, Blog, Comment)
+    # 预先查询首页和评论管理分页要用的总数，之后由orm在内存里维护，并定期和数据库对账
+    await orm.counts.seed(Blog, Comment)
+    orm.start_count_reconciler(loop, configs.db.get('count_reconcile_interval', 300))
     # 创建app对象，同时传入上文定义的拦截器middlewares
     app = web.Application(loop=loop, middlewares=[
-         logger_factory, auth_factory, response_factory
+         logger_factory, query_count_factory, auth_factory, response_factory
     ])
     # 初始化jinja2模板，并传入时间过滤器
     init_jinja2(app, filters=dict(datetime=datetime_filter))
@@ -213,5 +243,13 @@ async def init(loop):
 #从asyncio模块中直接获取一个EventLoop的引用，然后把需要执行的协程扔到EventLoop中执行
 loop = asyncio.get_event_loop()
 loop.run_until_complete(init(loop))
+# 收到SIGTERM时停止事件循环，和Ctrl+C一样走到下面的退出流程
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
 #运行协程，直到调用stop()
-loop.run_forever()
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    # 退出前写入写缓冲(Comment的__write_buffer__)里还没有提交的行，否则这些评论会丢失
+    loop.run_until_complete(orm.flush_writes())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'milletluo'
+
+'''
+比较查询结果构造成对象的开销(不需要数据库)：
+  DictCursor + Model(**row)  : 原来的做法，驱动为每行构造一个dict，Model再复制一次
+  Cursor + Model(zip())      : tuple游标，按__select__的列顺序直接构造Model
+  Cursor + Record(*row)      : tuple游标，按位置构造紧凑的__slots__ Record
+用法：python3 bench_hydrate.py [行数]
+'''
+
+import sys, time, timeit, tracemalloc
+
+from models import Blog
+
+def make_rows(n):
+    names = Blog._column_names()
+    rows = []
+    for i in range(n):
+        rows.append(('%050d' % i, 'u' * 50, 'user', 'about:blank', 'blog %s' % i, 'summary ' * 20, 'content ' * 200, time.time()))
+    return names, rows
+
+def dict_model(names, rows):
+    # aiomysql的DictCursor对每行做dict(zip(fields, row))
+    return [Blog(**dict(zip(names, r))) for r in rows]
+
+def tuple_model(names, rows):
+    return [Blog(zip(names, r)) for r in rows]
+
+def tuple_record(names, rows):
+    R = Blog.__record__
+    return [R(*r) for r in rows]
+
+def measure(fn, names, rows, repeat=5):
+    best = min(timeit.repeat(lambda: fn(names, rows), number=1, repeat=repeat))
+    tracemalloc.start()
+    objs = fn(names, rows)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return best / len(rows) * 1e9, size / len(rows)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    names, rows = make_rows(n)
+    print('%d rows' % n)
+    print('%-28s %12s %14s' % ('', 'ns/row', 'bytes/row'))
+    for label, fn in (('DictCursor + Model(**row)', dict_model), ('Cursor + Model(zip())', tuple_model), ('Cursor + Record(*row)', tuple_record)):
+        ns, size = measure(fn, names, rows)
+        print('%-28s %12.0f %14.0f' % (label, ns, size))
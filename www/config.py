@@ -35,8 +35,8 @@ def merge(defaults, override):
     r = {}
     for k, v in defaults.items():
         if k in override:
-            #如果该配置是字典，递归
-            if isinstance(v, dict):
+            #如果该配置是字典，递归；默认值是空字典时(如db.databases)没有可以融合的键，直接使用自定义配置
+            if isinstance(v, dict) and v:
                 r[k] = merge(v, override[k])
             else:
                 r[k] = override[k]
@@ -6,11 +6,50 @@ __author__ = 'milletluo'
 configs = {
     'debug':True,
     'db': {
+        'driver': 'mysql',  # 或'sqlite'，使用SQLite时只需要path，不需要MySQL服务器
+        'path': 'awesome.db',  # SQLite数据库文件
+        'create_tables': False,  # 启动时按models的定义建表(已存在的表不变)，使用SQLite时应设为True
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 只读副本，每一项只需写出与主库不同的参数，比如{'host': '10.0.0.2'}；查询会分摊到副本上
+        'replicas': [],
+        'replica_strategy': 'round_robin',  # 或'least_busy'
+        # 其他命名数据库，每一项只需写出与这里不同的参数，比如{'comments': {'host': '10.0.0.3'}}
+        # Model通过__database__使用，没有在这里配置的名字使用上面的默认数据库
+        # 分片：{'comments': {'shards': [{'host': '10.0.0.3'}, {'host': '10.0.0.4'}]}}，评论按blog_id分布到各分片
+        'databases': {},
+        'read_your_writes': 1.0,  # 请求写入数据后多少秒内的查询仍然走主库；表被写入后这段时间内所有请求填充缓存的查询也走主库
+        'minsize': 1,  # 连接池的最小、最大连接数
+        'maxsize': 10,
+        'acquire_timeout': 10,  # 取连接最多等待的秒数
+        'request_connections': 3,  # 一个请求里并发查询(orm.gather)最多同时占用的连接数
+        # 开启后在minsize和maxsize之间按取连接的等待时间自动调整可用的连接数
+        'adaptive': {
+            'enabled': False,
+            'interval': 10,  # 每隔多少秒调整一次
+            'grow_wait': 0.02,  # 等待时间的p95超过多少秒时增加连接
+            'step': 2
+        },
+        'count_reconcile_interval': 300,  # 内存中维护的行数每隔多少秒和数据库对账一次
+        'repeated_query_warn': 3,  # 一个请求里同一条语句执行这么多次时输出N+1查询的警告
+        # 开启了__query_cache__的Model的查询结果缓存，表有写入时失效，ttl兜底其他进程的写入
+        'query_cache': {
+            'size': 512,  # 最多缓存多少条查询结果
+            'ttl': 30,
+            'max_rows': 1000  # 行数更多的结果不缓存
+        },
+        # 耗时超过threshold秒的语句连同EXPLAIN的结果写入慢查询日志
+        'slow_query': {
+            'threshold': 0.2,
+            'explain_interval': 60,  # 同一条语句每隔多少秒最多EXPLAIN一次
+            'file': 'slow_query.log'
+        }
+    },
+    'ids': {
+        'worker_id': 0  # 多个进程同时写库时每个进程要配置不同的worker id(0~31)
     },
     'session': {
         'secret': 'Awesome'
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'milletluo'
+
+'''
+数据库驱动：orm通过驱动创建连接池、取得游标，以及生成与数据库相关的SQL(占位符、建表语句、EXPLAIN)
+MySQLDriver使用aiomysql，只有真正用到时才导入
+SQLiteDriver在后台线程里执行sqlite3，不需要数据库服务器，适合单机部署、本地测试和性能测试
+'''
+
+import asyncio, collections, concurrent.futures, sqlite3
+
+# 游标的种类：TUPLE每行是tuple，DICT每行是dict，STREAM是逐批读取的dict游标(用于select_iter)
+TUPLE, DICT, STREAM = 'tuple', 'dict', 'stream'
+
+class Driver(object):
+
+    name = None
+    explain_prefix = 'explain '
+
+    # 创建连接池，返回的对象要提供acquire()、release(conn)、clear()以及size、freesize、minsize、maxsize
+    async def create_pool(self, loop, kw):
+        raise NotImplementedError
+
+    # conn.cursor()的参数
+    def cursor_type(self, kind):
+        raise NotImplementedError
+
+    # orm里的SQL统一使用?作为占位符，转换成驱动使用的占位符
+    def sql(self, sql):
+        return sql
+
+    # Model的建表语句，返回语句的list
+    def create_table(self, cls):
+        raise NotImplementedError
+
+    # 查询数据库里cls的表上已有的索引，结果的name列是索引名，advise()用它和Model声明的索引比较
+    def index_names_sql(self, cls):
+        raise NotImplementedError
+
+    # Model声明的索引在数据库里的名字
+    def index_name(self, cls, index):
+        return index.name
+
+    # 把INSERT语句改成upsert：key字段冲突时更新columns字段，columns为空时跳过冲突的行
+    def upsert(self, insert, key, columns):
+        raise NotImplementedError
+
+class MySQLDriver(Driver):
+
+    name = 'mysql'
+
+    def __init__(self):
+        self._aiomysql = None
+
+    # 第一次用到时才导入aiomysql，只使用SQLite时不需要安装它
+    @property
+    def aiomysql(self):
+        if self._aiomysql is None:
+            import aiomysql
+            self._aiomysql = aiomysql
+        return self._aiomysql
+
+    # 创建一个aiomysql连接池
+    async def create_pool(self, loop, kw):
+        return await self.aiomysql.create_pool(
+            #dict的get方法，如果dict中有对应的value值，则返回对应于key的value值，否则返回默认值
+            #例如下面的host，如果dict里面没有'host',则返回后面的默认值，也就是'localhost'
+            host = kw.get('host', 'localhost'),
+            port = kw.get('port', 3306),
+            user = kw['user'],
+            password = kw['password'],
+            db = kw['db'],
+            charset = kw.get('charset','utf8'),
+            autocommit = kw.get('autocommit',True),#默认自动提交事务，不用手动去提交事务
+            maxsize = kw.get('maxsize',10),
+            minsize = kw.get('minsize',1),
+            loop = loop# 传递消息循环对象，用于异步执行
+        )
+
+    def cursor_type(self, kind):
+        aiomysql = self.aiomysql
+        return {TUPLE: aiomysql.Cursor, DICT: aiomysql.DictCursor, STREAM: aiomysql.SSDictCursor}[kind]
+
+    #SQL语句的占位符是?，而MySQL的占位符是%s
+    def sql(self, sql):
+        return sql.replace('?', '%s')
+
+    def create_table(self, cls):
+        return [cls.create_table_sql().replace('create table ', 'create table if not exists ', 1)]
+
+    def index_names_sql(self, cls):
+        return "select distinct `index_name` `name` from information_schema.statistics where `table_schema`=database() and `table_name`='%s'" % cls.__table__
+
+    # MySQL在主键或任何一个唯一索引冲突时都会更新，不需要指定key
+    # 被更新的行受影响的行数是2，没有变化的是0，所以不能从行数算出插入了多少行
+    def upsert(self, insert, key, columns):
+        if not columns:
+            return '%s on duplicate key update `%s`=`%s`' % (insert, key, key)
+        return '%s on duplicate key update %s' % (insert, ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns))
+
+# ==================================SQLite=====================================
+
+# 一个sqlite3连接，所有操作都在它专属的线程里执行，不阻塞事件循环
+# sqlite3连接工作在autocommit模式，事务由begin()、commit()、rollback()显式控制
+class SQLiteConnection(object):
+
+    def __init__(self, loop, path, timeout, pragmas):
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._path = path
+        self._timeout = timeout
+        self._pragmas = pragmas
+        self._conn = None
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        for pragma in self._pragmas:
+            self._conn.execute('pragma %s' % pragma)
+
+    async def open(self):
+        await self._run(self._open)
+        return self
+
+    def cursor(self, kind=TUPLE):
+        return SQLiteCursor(self, kind)
+
+    # 写事务用begin immediate一开始就拿到写锁，避免两个事务都读过之后再升级写锁时互相等待
+    async def begin(self):
+        await self._run(self._conn.execute, 'begin immediate')
+
+    async def commit(self):
+        await self._run(self._conn.execute, 'commit')
+
+    async def rollback(self):
+        if self._conn.in_transaction:
+            await self._run(self._conn.execute, 'rollback')
+
+    def close(self):
+        self._executor.submit(self._conn.close)
+        self._executor.shutdown(wait=False)
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, kind):
+        self._conn = conn
+        self._kind = kind
+        self._cur = None
+        self._names = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._cur is not None:
+            await self._conn._run(self._cur.close)
+
+    def _execute(self, sql, args):
+        self._cur = self._conn._conn.execute(sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        if self._cur.description:
+            self._names = [d[0] for d in self._cur.description]
+
+    async def execute(self, sql, args=()):
+        await self._conn._run(self._execute, sql, args)
+
+    def _rows(self, rows):
+        if self._kind == TUPLE:
+            return rows
+        names = self._names
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchall(self):
+        return self._rows(await self._conn._run(self._cur.fetchall))
+
+    async def fetchmany(self, size=1):
+        return self._rows(await self._conn._run(self._cur.fetchmany, size))
+
+# 与aiomysql的连接池接口相同的SQLite连接池
+# WAL模式下读不阻塞写，多个连接可以同时读；写操作由SQLite的锁串行执行，等待超过timeout秒报错
+class SQLitePool(object):
+
+    def __init__(self, loop, path, minsize, maxsize, timeout, pragmas):
+        if path == ':memory:':
+            maxsize = minsize = 1  # 每个连接各有一个独立的内存数据库，只能用一个连接
+        self._loop = loop
+        self._path = path
+        self._timeout = timeout
+        self._pragmas = pragmas
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._free = collections.deque()
+        self._used = set()
+        self._sem = asyncio.Semaphore(maxsize)
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def fill(self):
+        while self.size < self._minsize:
+            self._free.append(await self._connect())
+
+    def _connect(self):
+        return SQLiteConnection(self._loop, self._path, self._timeout, self._pragmas).open()
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            conn = self._free.popleft() if self._free else await self._connect()
+        except BaseException:
+            self._sem.release()
+            raise
+        self._used.add(conn)
+        return conn
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if conn._conn.in_transaction:  # 异常退出时没有提交的事务，不能把它留给下一个使用者
+            conn._conn.rollback()
+        self._free.append(conn)
+        self._sem.release()
+
+    # 关闭空闲的连接
+    async def clear(self):
+        while self._free:
+            self._free.popleft().close()
+
+    def close(self):
+        for conn in list(self._free) + list(self._used):
+            conn.close()
+        self._free.clear()
+        self._used.clear()
+
+    async def wait_closed(self):
+        pass
+
+class SQLiteDriver(Driver):
+
+    name = 'sqlite'
+    explain_prefix = 'explain query plan '
+
+    # path是数据库文件；journal_mode=wal使读写可以并发，synchronous=normal在WAL下只在checkpoint时fsync
+    async def create_pool(self, loop, kw):
+        pragmas = ['journal_mode=wal', 'synchronous=%s' % kw.get('synchronous', 'normal'), 'foreign_keys=off']
+        pool = SQLitePool(loop or asyncio.get_event_loop(), kw.get('path', kw.get('db', 'awesome') + '.db'), kw.get('minsize', 1),
+                          kw.get('maxsize', 10), kw.get('busy_timeout', 5.0), pragmas)
+        await pool.fill()
+        return pool
+
+    def cursor_type(self, kind):
+        return kind
+
+    # SQLite的建表语句里不能写索引，索引名在整个数据库里唯一，所以加上表名作为前缀
+    def create_table(self, cls):
+        lines = ['`%s` %s not null' % (k, f.column_type) for k, f in cls.__mappings__.items()]
+        lines.append('primary key (`%s`)' % cls.__primary_key__)
+        statements = ['create table if not exists `%s` (\n    %s\n)' % (cls.__table__, ',\n    '.join(lines))]
+        for idx in cls.__indexes__:
+            statements.append('create %sindex if not exists `%s` on `%s` (%s)' % ('unique ' if idx.unique else '', self.index_name(cls, idx),
+                              cls.__table__, ', '.join('`%s`' % c for c in idx.columns)))
+        return statements
+
+    def index_names_sql(self, cls):
+        return "select `name` from sqlite_master where type='index' and tbl_name='%s'" % cls.__table__
+
+    def index_name(self, cls, index):
+        return '%s_%s' % (cls.__table__, index.name)
+
+    # SQLite 3.24以上支持on conflict，key字段上要有主键或唯一索引
+    def upsert(self, insert, key, columns):
+        if not columns:
+            return '%s on conflict(`%s`) do nothing' % (insert, key)
+        return '%s on conflict(`%s`) do update set %s' % (insert, key, ', '.join('`%s`=excluded.`%s`' % (c, c) for c in columns))
+
+_drivers = dict(mysql=MySQLDriver, sqlite=SQLiteDriver)
+
+# 按名字取得驱动，configs.db['driver']，默认mysql
+def get_driver(name='mysql'):
+    try:
+        return _drivers[name]()
+    except KeyError:
+        raise ValueError('unknown database driver: %s' % name)
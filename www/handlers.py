@@ -8,14 +8,16 @@ __author__ = 'milletluo'
 import re, time, json, logging, hashlib, base64, asyncio
 # markdown2模块是一个支持markdown文本输入的模块，是Trent Mick写的开源模块，我们将其拷贝在本文件夹中，在这里调用
 import markdown2
+import orm
 from aiohttp import web
 from coroweb import get, post
-from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page
+from apis import APIValueError, APIResourceNotFoundError, APIError, APIPermissionError, Page, CursorPage
 from models import User, Comment, Blog, next_id
 from config import configs
 
 COOKIE_NAME = 'awesession'  # cookie名，用于设置cookie
 _COOKIE_KEY = configs.session.secret  # cookie密钥，作为加密cookie的原始字符串的一部分
+PAGE_SIZE = 10  # 每页显示的博客、评论数
 
 # 在api_create_blog()（实现博客创建功能）中被调用
 # 验证用户身份
@@ -37,6 +39,28 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 按页码或游标取出cls的一页数据(按created_at倒序)，返回(分页对象, 数据list)
+# 数据是只读的Record，用于模板展示和JSON
+# cursor为None时使用Page按offset分页，否则使用CursorPage做keyset分页，深翻页也只走一次索引定位
+# kw会传给findAll()，比如defer=['content']
+# 总数(由orm.counts在内存里维护)和本页数据互不依赖，用orm.gather()并发查询
+async def get_page_items(cls, page, cursor, **kw):
+    if cursor is not None:
+        p = CursorPage(0, cursor, PAGE_SIZE)  # 总数还没有查询，先只用它解析游标
+        if p.after is None and p.before is None:
+            query = cls.findRecords(orderBy='created_at desc, id desc', limit=p.limit, **kw)
+        else:
+            query = cls.findRecords(after=p.after, before=p.before, limit=p.limit, **kw)
+        num, items = await orm.gather(cls.count(), query)
+        p = CursorPage(num, cursor, PAGE_SIZE)
+        return p, p.paginate(items)
+    # 总数由orm.counts在内存里维护，先用它检查页码，超出范围的页码不去执行offset很大的查询
+    num = await cls.count()
+    p = Page(num, get_page_index(page), PAGE_SIZE)
+    if p.limit == 0:
+        return p, []
+    return p, await cls.findRecords(orderBy='created_at desc', limit=(p.offset, p.limit), **kw)
+
 # 文本转html
 # 这个函数在get_blog()中被调用
 def text2html(text):
@@ -58,7 +82,7 @@ def user2cookie(user, max_age):
     # 利用用户id，加密后的密码，失效时间，加上cookie密钥，组合成待加密的原始字符串
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
     # 生成加密的字符串，并于用户id，失效时间共同组成cookie
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]  # id是int
     return '-'.join(L)
 
 # 解密cookie
@@ -96,15 +120,10 @@ async def cookie2user(cookie_str):
 # day14中定义
 # 页面：首页
 @get('/')
-async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    # 创建Page对象（Page对象在apis.py中定义）
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+async def index(*, page='1', cursor=None):
+    # 创建Page或CursorPage对象（在apis.py中定义）并取出本页的博客
+    # 列表只显示标题和摘要，不查询正文content
+    page, blogs = await get_page_items(Blog, page, cursor, defer=['content'])
     # 返回一个模板，指示使用何种模板，模板的内容
     # app.py的response_factory将会对handler.py的返回值进行分类处理
     return {
@@ -116,7 +135,7 @@ async def index(*, page='1'):
 # 用户信息接口,用于返回机器能识别的用户信息
 @get('/api/users')
 async def api_get_users():
-    users = await User.findAll(orderBy='created_at desc')
+    users = await User.findRecords(orderBy='created_at desc')
     for u in users:
         # 将user中的password隐藏
         u.passwd = '******'
@@ -152,9 +171,8 @@ def signout(request):
 # 页面：博客详情页
 @get('/blog/{id}')
 async def get_blog(id, request):
-    blog = await Blog.find(id)  # 通过id从数据库中拉去博客信息
-    # 从数据库拉取指定blog的全部评论，按时间降序排序，即最新的排在最前
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # 通过id从数据库中拉去博客信息，同时拉取指定blog的全部评论，按时间降序排序，即最新的排在最前
+    blog, comments = await orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id], orderBy='created_at desc'))
     # 将每条评论都转化成html格式
     for c in comments:
         c.html_content = text2html(c.content)
@@ -184,10 +202,11 @@ def manage_create_blog():
 # day12中定义
 # 页面：日志列表页
 @get('/manage/blogs')
-def manage_blogs(*, page='1'):
+def manage_blogs(*, page='1', cursor=None):
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': get_page_index(page),
+        'cursor': cursor  # 不为None时页面改用游标翻页
 }
 
 # day14定义
@@ -199,10 +218,11 @@ def manage():
 # day14定义
 # 页面：评论列表页
 @get('/manage/comments')
-def manage_comments(*, page='1'):
+def manage_comments(*, page='1', cursor=None):
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'page_index': get_page_index(page),
+        'cursor': cursor  # 不为None时页面改用游标翻页
     }
 
 # day14定义
@@ -304,7 +324,7 @@ async def authenticate(*, email, passwd):  # 通过邮箱与密码验证登陆
     # 以下步骤合成为一步就是:sha1 = hashlib.sha1((user.id+":"+passwd).encode("utf-8"))
     # 对照用户注册时对原始密码的操作(见api_register_user),操作完全一样
     sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
+    sha1.update((user.legacy_id or str(user.id)).encode('utf-8'))  # 迁移前注册的用户用旧的字符串id加盐
     sha1.update(b':')
     sha1.update(passwd.encode('utf-8'))
     if user.passwd != sha1.hexdigest():
@@ -347,29 +367,16 @@ async def api_create_blog(request, *, name, summary, content):
 # day12定义
 # 获取博客
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)') # num为博客总数
-    p = Page(num, page_index)  # 创建Page对象（Page对象在apis.py中定义）
-    if num == 0:
-        return dict(page=p, blogs=())  # 若博客数为0,返回字典,将被app.py的response中间件再处理
-    # 博客总数不为0,则从数据库中抓取博客
-    # limit强制select语句返回指定的记录数,前一个参数为偏移量,后一个参数为记录的最大数目
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_blogs(*, page='1', cursor=None):
+    # 按页码或游标取出本页博客，cursor参数为上一次返回的page.next_cursor或page.prev_cursor
+    p, blogs = await get_page_items(Blog, page, cursor, defer=['content'])
     return dict(page=p, blogs=blogs) # 返回字典,以供response中间件处理
 
 # day14定义
 # API：获取评论
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')  # num为评论总数
-    p = Page(num, page_index)  # 创建Page对象，保存页面信息
-    if num == 0:
-        return dict(page=p, comments=())  # 若评论数为零，返回字典，将会被app.py的response中间件再处理
-    # 博客总数不为0,则从数据库中抓取博客
-    # limit强制select语句返回指定的记录数,前一个参数为偏移量,后一个参数为记录的最大数目
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page='1', cursor=None):
+    p, comments = await get_page_items(Comment, page, cursor)
     return dict(page=p, comments=comments)
 
 # day14定义
@@ -389,7 +396,8 @@ async def api_create_comment(id, request, *, content):
         raise APIResourceNotFoundError('Blog')
     # 创建评论对象
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()  # 储存评论到数据库中
+    # 储存评论到数据库中；不放在事务里，才能经过Comment的写缓冲和同时提交的其他评论一起写入
+    await comment.save()
     return comment  # 返回评论
 
 # day14定义
@@ -397,12 +405,50 @@ async def api_create_comment(id, request, *, content):
 @post('/api/comments/{id}/delete')
 async def api_delete_comments(id, request):
     check_admin(request)  #查看权限，是否是管理员
-    c = await Comment.find(id)  # 从数据库中拉去评论
-    if c is None:
+    # 直接按主键删除，不用先把评论查出来；没有删除任何行说明评论不存在
+    if await Comment.delete_many([id]) == 0:
         raise APIResourceNotFoundError('Comment')
-    await c.remove()  # 删除评论
     return dict(id=id)  # 返回被删除评论的id
 
+# API：批量删除评论，用于清理垃圾评论
+# ids是评论id的list(或用逗号分隔的字符串)，user_id是要删除其全部评论的用户
+@post('/api/comments/delete')
+async def api_delete_comments_bulk(request, *, ids=None, user_id=None):
+    check_admin(request)
+    if isinstance(ids, str):
+        ids = [i for i in ids.split(',') if i.strip()]
+    if not ids and not user_id:
+        raise APIValueError('ids', 'ids or user_id is required.')
+    deleted = 0
+    if ids:
+        if len(ids) > 1000:
+            raise APIValueError('ids', 'at most 1000 ids at a time.')
+        deleted += await Comment.delete_many(ids)
+    if user_id:
+        deleted += await Comment.delete_where('user_id=?', [user_id])
+    return dict(deleted=deleted)
+
+# API：数据库连接池和SQL耗时统计，只有管理员可以查看
+@get('/api/stats/db')
+def api_db_stats(request):
+    check_admin(request)
+    return orm.metrics()
+
+# API：各SQL语句的执行次数、耗时分位数(p50/p95/p99)、返回行数和取连接的等待时间，只有管理员可以查看
+# sort可以是total、count、avg、p95、p99、max、rows、slow等，见orm.QUERY_REPORT_SORTS
+@get('/api/stats/queries')
+def api_query_stats(request, *, sort='total', limit='50'):
+    check_admin(request)
+    if sort not in orm.QUERY_REPORT_SORTS:
+        raise APIValueError('sort', 'sort must be one of: %s' % ', '.join(orm.QUERY_REPORT_SORTS))
+    return dict(queries=orm.query_report(sort, get_page_index(limit)))
+
+# API：对执行过的查询做EXPLAIN，报告缺少的索引，只有管理员可以查看
+@get('/api/stats/indexes')
+async def api_index_advice(request):
+    check_admin(request)
+    return dict(report=await orm.advise([User, Blog, Comment]))
+
 # day14定义
 # API:修改博客
 @post('/api/blogs/{id}')
@@ -427,6 +473,11 @@ async def api_update_blog(id, request, *, name, summary, content):
 @post('/api/blogs/{id}/delete')
 async def api_delete_blog(request, *, id):
     check_admin(request)
-    blog = await Blog.find(id)
-    await blog.remove()
+    # 博客和它的评论在同一个事务里删除；评论单独配置数据库(或分片)时，两边各有一个事务
+    async with orm.transaction(), orm.transaction(Comment.database_for(id)):
+        blog = await Blog.find(id)
+        if blog is None:
+            raise APIResourceNotFoundError('Blog')
+        await Comment.delete_where('blog_id=?', [id])
+        await blog.remove()
     return dict(id=id)
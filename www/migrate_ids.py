@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'milletluo'
+
+'''
+把users、blogs、comments的varchar(50)字符串主键迁移为snowflake生成的bigint主键
+
+旧id的前15位是创建时的毫秒时间戳，新id用这个时间戳生成，迁移后id的先后顺序不变
+blogs.user_id、comments.blog_id、comments.user_id按旧id关联到新id
+旧的用户id保存在users.legacy_id里，老用户的密码是用它加盐的，迁移后仍然可以登录
+迁移后cookie里的旧id不再有效，用户需要重新登录
+
+迁移前先停止应用并备份数据库，然后执行：python3 migrate_ids.py
+'''
+
+import orm, asyncio, sys
+from config import configs
+
+# 每个事务里最多更新多少行
+BATCH = 500
+
+# 旧id形如'%015d%s000' % (毫秒时间戳, uuid4)，取不到时间戳时用created_at
+def legacy_timestamp(id, created_at):
+    head = id[:15]
+    return int(head) if head.isdigit() else int(created_at * 1000)
+
+# 为table的每一行生成新id，写入new_id列
+async def assign_ids(table, ids):
+    rows = []
+    # 旧id以补零的时间戳开头，按字符串排序就是按时间排序
+    async for rs in orm.select_iter('select `id`, `created_at` from `%s` order by `id`' % table, None, BATCH):
+        rows.extend((r['id'], r['created_at']) for r in rs)
+    statements = [('update `%s` set `new_id`=? where `id`=?' % table, [ids.next_id(legacy_timestamp(id, created_at)), id]) for id, created_at in rows]
+    for i in range(0, len(statements), BATCH):
+        await orm.execute_batch(statements[i:i + BATCH])
+    print('%s: %s rows' % (table, len(rows)))
+
+async def has_column(table, column):
+    rs = await orm.select("show columns from `%s` like '%s'" % (table, column), None)
+    return len(rs) > 0
+
+async def has_index(table, name):
+    rs = await orm.select('show index from `%s`' % table, None)
+    return any(r['Key_name'] == name for r in rs)
+
+async def migrate():
+    await orm.create_pool(loop=loop, **configs.db)
+    if await has_column('users', 'legacy_id'):
+        print('already migrated.')
+        return
+    # 1. 新增bigint列，和旧列并存
+    await orm.execute("alter table `users` add column `new_id` bigint unsigned not null default 0, add column `legacy_id` varchar(50) not null default ''", None)
+    await orm.execute('alter table `blogs` add column `new_id` bigint unsigned not null default 0, add column `new_user_id` bigint unsigned not null default 0', None)
+    await orm.execute('alter table `comments` add column `new_id` bigint unsigned not null default 0, add column `new_blog_id` bigint unsigned not null default 0, add column `new_user_id` bigint unsigned not null default 0', None)
+    # 2. 生成新的主键；每个表用一个新的生成器，否则后面的表的时间戳会被前一个表最新的时间戳顶替
+    for table in ('users', 'blogs', 'comments'):
+        await assign_ids(table, orm.Snowflake(**configs.ids))
+    # 3. 按旧id关联，填入新的外键
+    await orm.execute('update `users` set `legacy_id`=`id`', None)
+    await orm.execute('update `blogs` b join `users` u on b.`user_id`=u.`id` set b.`new_user_id`=u.`new_id`', None)
+    await orm.execute('update `comments` c join `blogs` b on c.`blog_id`=b.`id` set c.`new_blog_id`=b.`new_id`', None)
+    await orm.execute('update `comments` c join `users` u on c.`user_id`=u.`id` set c.`new_user_id`=u.`new_id`', None)
+    for table, column in (('blogs', 'new_user_id'), ('comments', 'new_blog_id'), ('comments', 'new_user_id')):
+        rs = await orm.select('select count(*) _num_ from `%s` where `%s`=0' % (table, column), None)
+        if rs[0]['_num_']:
+            print('warning: %s rows in %s reference a missing row, %s set to 0' % (rs[0]['_num_'], table, column[4:]))
+    # 4. 删除旧列，新列改回原来的名字
+    await orm.execute('alter table `users` drop primary key, drop column `id`, change `new_id` `id` bigint unsigned not null first, add primary key (`id`)', None)
+    await orm.execute('alter table `blogs` drop primary key, drop column `id`, drop column `user_id`, '
+                      'change `new_id` `id` bigint unsigned not null first, change `new_user_id` `user_id` bigint unsigned not null after `id`, '
+                      'add primary key (`id`)', None)
+    # 联合索引里的blog_id列被删除后索引会只剩created_at，先删掉再按新列重建
+    if await has_index('comments', 'idx_blog_id_created_at'):
+        await orm.execute('alter table `comments` drop index `idx_blog_id_created_at`', None)
+    await orm.execute('alter table `comments` drop primary key, drop column `id`, drop column `blog_id`, drop column `user_id`, '
+                      'change `new_id` `id` bigint unsigned not null first, change `new_blog_id` `blog_id` bigint unsigned not null after `id`, '
+                      'change `new_user_id` `user_id` bigint unsigned not null after `blog_id`, '
+                      'add key `idx_blog_id_created_at` (`blog_id`, `created_at`), add primary key (`id`)', None)
+    print('done.')
+
+if __name__ == '__main__':
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate())
+    loop.close()
+    if loop.is_closed():
+        sys.exit(0)
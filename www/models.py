@@ -7,46 +7,61 @@ __author__ = 'milletluo'
 采用orm构建Web App需要的3个表
 '''
 
-# uuid是python中生成唯一ID的库
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
-# 这个函数的作用是生成一个基于时间的独一无二的id，来作为数据库表中每一行的主键
-def next_id():
-    # time.time() 返回当前时间的时间戳(相对于1970.1.1 00:00:00以秒计算的偏移量)
-    # uuid4()——由伪随机数得到，有一定的重复概率，该概率可以计算出来。
-    return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+# next_id()生成一个基于时间、按时间递增的64位整数id，来作为数据库表中每一行的主键，见orm.Snowflake
+# 注意default要传next_id函数本身，而不是next_id()，否则所有行都会用导入时生成的同一个id
+from orm import Model, StringField, BooleanField, FloatField, TextField, IdField, Index, next_id
 
 class User(Model):
     __table__ = 'users'
     """docstring for User"""
-    id = StringField(primary_key = True, default = next_id(), ddl = 'varchar(50)')
-    email = StringField(ddl = 'varchar(50)')
+    __cache__ = dict(size=1024, ttl=300)  # 每个登录请求都会按id查用户，开启行缓存
+    id = IdField(primary_key = True, default = next_id)
+    email = StringField(ddl = 'varchar(50)', unique = True)# 登录和注册都按email查询
     passwd = StringField(ddl = 'varchar(50)')
     admin = BooleanField()
     name = StringField(ddl = 'varchar(50)')
     image = StringField(ddl = 'varchar(500)')
-    created_at = FloatField(default = time.time)# 创建时间默认是为当前时间
+    legacy_id = StringField(ddl = 'varchar(50)', default = '')# 迁移前的字符串id，老用户的密码是用它加盐的
+    created_at = FloatField(default = time.time, index = True)# 创建时间默认是为当前时间
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(size=256, ttl=60)
+    __query_cache__ = True  # 首页和博客列表对每个访客执行相同的查询
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    user_id = IdField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    # 博客详情页按blog_id取评论并按created_at排序
+    __indexes__ = [Index('blog_id', 'created_at')]
+    __query_cache__ = True  # 博客详情页的评论列表
+    # 评论写入最多，可以在configs.db.databases里把comments单独配置到一台服务器上，没有配置时使用默认数据库
+    __database__ = 'comments'
+    # comments配置了shards时按blog_id分片，同一篇博客的评论在同一个分片上，博客详情页只查一个分片
+    __shard_key__ = 'blog_id'
+    # 评论集中涌入时，5毫秒内或满100条的save()合并成一条多行INSERT写入
+    __write_buffer__ = dict(delay=0.005, size=100)
 
-    id = StringField(primary_key=True, default=next_id(), ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    blog_id = IdField()
+    user_id = IdField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
+
+# 打印根据Model定义生成的建表语句，用来核对schema.sql
+if __name__ == '__main__':
+    for m in (User, Blog, Comment):
+        print(m.create_table_sql())
+        print()
@@ -10,75 +10,670 @@ orm.
 把yield from替换为await。
 '''
 
-import asyncio, logging, aiomysql, sys
+import asyncio, logging, sys, time, collections, contextlib, contextvars, bisect, re, threading, hashlib, itertools, functools
+import drivers
 
 # 输出信息，让你知道这个时间点程序在做什么
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
+# =================================以下是连接池与统计区====================================
+
+# 耗时分布直方图，单位为秒
+class Histogram(object):
+
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BUCKETS) + 1)  # 最后一格统计超过5秒的
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        labels = ['<=%gms' % (b * 1000) for b in self.BUCKETS] + ['>%gms' % (self.BUCKETS[-1] * 1000)]
+        return dict(count=self.count, total=self.total, avg=self.total / self.count if self.count else 0.0, max=self.max,
+                    buckets=dict((k, n) for k, n in zip(labels, self.buckets) if n))
+
+# 一个SQL模板(带?占位符的语句)的执行统计：执行耗时、取连接的等待时间、返回或影响的行数
+# 耗时分位数按最近WINDOW次执行计算，反映当前的情况而不是启动以来的累计
+class StatementStats(object):
+
+    WINDOW = 1000
+
+    def __init__(self):
+        self.time = Histogram()
+        self.wait = Histogram()
+        self.rows = 0
+        self.slow = 0  # 超过慢查询阈值的次数
+        self._recent = collections.deque(maxlen=self.WINDOW)
+
+    def add(self, seconds, rows, wait=0.0):
+        self.time.add(seconds)
+        self.wait.add(wait)
+        self.rows += rows
+        self._recent.append(seconds)
+
+    def percentiles(self):
+        recent = sorted(self._recent)
+        if not recent:
+            return dict(p50=0.0, p95=0.0, p99=0.0)
+        pick = lambda q: recent[min(len(recent) - 1, int(len(recent) * q))]
+        return dict(p50=pick(0.5), p95=pick(0.95), p99=pick(0.99))
+
+    def summary(self):
+        d = dict(count=self.time.count, total=self.time.total, avg=self.time.total / self.time.count if self.time.count else 0.0,
+                 max=self.time.max, rows=self.rows, avg_rows=self.rows / self.time.count if self.time.count else 0.0,
+                 wait=self.wait.total / self.wait.count if self.wait.count else 0.0, slow=self.slow,
+                 buckets=self.time.summary()['buckets'])
+        d.update(self.percentiles())
+        return d
+
+# 每个SQL模板的执行统计
+query_stats = collections.defaultdict(StatementStats)
+# 每个SELECT模板最近一次执行的(SQL, 参数, 数据库名)，advise()用它执行EXPLAIN
+query_samples = {}
+
+_RE_IN_LIST = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_RE_VALUES_ROWS = re.compile(r'(\((?:\s*\?\s*,)*\s*\?\s*\))(?:\s*,\s*\1)+')
+
+# 统计用的SQL模板：in (?, ?, ...)的值的个数和多行INSERT的行数不同时仍是同一个模板
+# 否则BatchLoader、delete_many()、save_many()每种长度各占一项统计
+@functools.lru_cache(maxsize=4096)
+def _template(sql):
+    sql = _RE_IN_LIST.sub('in (...)', sql)
+    return _RE_VALUES_ROWS.sub(r'\1, ...', sql)
+
+# 慢查询单独写入这个logger，create_pool()的slow_query参数可以把它输出到文件
+slow_log = logging.getLogger('orm.slow')
+_slow_query = dict(threshold=0.2, explain_interval=60)
+_explained = {}  # SQL模板 -> 上次EXPLAIN的时间，同一个模板每explain_interval秒最多EXPLAIN一次
+
+# select()和execute()每执行完一条语句调用一次，记录统计，超过阈值的写入慢查询日志
+def _profile(sql, args, seconds, rows, wait, database=None):
+    template = _template(sql)
+    stats = query_stats[template]
+    stats.add(seconds, rows, wait)
+    counter = _request_queries.get()
+    if counter is not None:
+        counter.add(template, seconds)
+    threshold = _slow_query['threshold']
+    if threshold is None or seconds < threshold or sql.startswith('explain '):
+        return
+    stats.slow += 1
+    slow_log.warning('slow query: %.1fms (wait %.1fms, rows %s): %s args: %s' % (seconds * 1000, wait * 1000, rows, sql, args))
+    now = time.monotonic()
+    if sql.split(None, 1)[0].lower() in ('select', 'update', 'delete') and now - _explained.get(template, -1e9) >= _slow_query['explain_interval']:
+        _explained[template] = now
+        # 在空的context中执行，EXPLAIN不属于调用者的事务
+        asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(_explain_slow(sql, args, database)), context=contextvars.Context())
+
+async def _explain_slow(sql, args, database=None):
+    try:
+        rs = await select(_database(database).driver.explain_prefix + sql, args, coalesce=False, database=database)
+    except Exception as e:
+        slow_log.warning('explain failed: %s: %s' % (sql, e))
+        return
+    for r in rs:
+        slow_log.warning('explain: %s' % ', '.join('%s=%s' % (k, v) for k, v in r.items()))
+
+# query_report()可以按这些统计项排序
+QUERY_REPORT_SORTS = ('count', 'total', 'avg', 'max', 'rows', 'avg_rows', 'wait', 'slow', 'p50', 'p95', 'p99')
+
+# 按total、count、avg、p95、p99等排序返回各SQL模板的统计，供管理接口展示
+def query_report(sort='total', limit=None):
+    if sort not in QUERY_REPORT_SORTS:
+        raise ValueError('cannot sort query report by: %s' % sort)
+    report = [dict(sql=sql, **stats.summary()) for sql, stats in list(query_stats.items())]
+    report.sort(key=lambda r: r.get(sort, 0), reverse=True)
+    return report[:limit] if limit else report
+
+# 一个请求(或一段代码)实际发到数据库的语句数和总耗时，命中缓存或被合并的查询不计入
+# 同一个SQL模板执行了多次，通常是在循环里逐个查询(N+1)，应该改用batchFind()或一次in查询
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.templates = collections.Counter()  # SQL模板 -> 执行次数
+
+    def add(self, sql, seconds):
+        self.count += 1
+        self.time += seconds
+        self.templates[sql] += 1
+
+    # 执行次数不少于threshold的SQL模板
+    def repeated(self, threshold=3):
+        return dict((sql, n) for sql, n in self.templates.items() if n >= threshold)
+
+    def __str__(self):
+        return '%s queries, %.1fms' % (self.count, self.time * 1000)
+
+# 当前请求的QueryCounter，由app.py的中间件设置；没有时不统计
+_request_queries = contextvars.ContextVar('orm_request_queries', default=None)
+
+# BatchLoader和WriteBuffer把多个请求的查询、插入合并成一条语句，在空的context中执行
+# 执行时用它代替QueryCounter，每条语句计入所有参与合并的请求
+class _CounterGroup(object):
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def add(self, sql, seconds):
+        for counter in self.counters:
+            counter.add(sql, seconds)
+
+# 记下当前请求的QueryCounter，合并执行时用_count_for()计入
+def _join_counter(counters):
+    counter = _request_queries.get()
+    if counter is not None and counter not in counters:
+        counters.append(counter)
+
+# 在当前context中把之后执行的语句计入counters(_join_counter()记下的各个请求)
+def _count_for(counters):
+    if counters:
+        _request_queries.set(_CounterGroup(counters))
+
+# 在当前context(请求)中开始统计，返回QueryCounter
+def track_queries():
+    counter = QueryCounter()
+    _request_queries.set(counter)
+    return counter
+
+# 测试用：断言with块中发到数据库的语句不超过limit条，同一个SQL模板执行不超过repeated次(N+1检测)
+# 例如 with orm.query_budget(2): await get_blog(id, request=request)
+# batchFind()、写缓冲合并执行的语句计入每个参与的调用者；慢查询的EXPLAIN和事务的begin/commit不计入
+@contextlib.contextmanager
+def query_budget(limit, repeated=None):
+    counter = QueryCounter()
+    token = _request_queries.set(counter)
+    try:
+        yield counter
+    finally:
+        _request_queries.reset(token)
+    if counter.count > limit:
+        raise AssertionError('query budget exceeded: %s > %s\n%s' % (counter.count, limit, '\n'.join(counter.templates)))
+    if repeated is not None and counter.repeated(repeated + 1):
+        raise AssertionError('repeated queries: %s' % counter.repeated(repeated + 1))
+
+# 包装一个驱动创建的连接池(如aiomysql连接池)：统计连接使用数、取连接的等待时间和超时次数
+# adaptive模式下，底层连接池按maxsize创建，这里再限制同时使用的连接数limit，
+# 并根据取连接的等待时间在minsize和maxsize之间自动增减limit
+class Pool(object):
+
+    def __init__(self, pool, name, acquire_timeout=None, adaptive=None):
+        self.pool = pool
+        self.name = name
+        self.acquire_timeout = acquire_timeout  # 取连接最多等待多少秒，None表示一直等
+        self.acquire_wait = Histogram()
+        self.timeouts = 0
+        self.in_use = 0
+        self.peak = 0  # 上次调整以来同时使用的最大连接数
+        self.limit = pool.maxsize
+        self.adaptive = adaptive
+        self._cond = None
+        self._waits = []  # 上次调整以来每次取连接的等待时间
+        if adaptive:
+            self.limit = pool.minsize
+            self._cond = asyncio.Condition()
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    @property
+    def freesize(self):
+        return self.pool.freesize
+
+    async def _acquire(self):
+        if self._cond is not None:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.in_use < self.limit)
+                self.in_use += 1
+            try:
+                return await self.pool.acquire()
+            except BaseException:
+                await self._release_slot()
+                raise
+        self.in_use += 1
+        try:
+            return await self.pool.acquire()
+        except BaseException:
+            self.in_use -= 1
+            raise
+
+    async def _release_slot(self):
+        if self._cond is not None:
+            async with self._cond:
+                self.in_use -= 1
+                self._cond.notify()
+        else:
+            self.in_use -= 1
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        start = time.monotonic()
+        try:
+            conn = await asyncio.wait_for(self._acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logging.warning('timeout acquiring connection from pool %s (in use: %s, limit: %s)' % (self.name, self.in_use, self.limit))
+            raise
+        wait = time.monotonic() - start
+        self.acquire_wait.add(wait)
+        if self.adaptive:
+            self._waits.append(wait)
+        if self.in_use > self.peak:
+            self.peak = self.in_use
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+            await self._release_slot()
+
+    # adaptive模式下定期调用：等待时间的p95超过grow_wait就增加limit，
+    # 几乎不用等待且使用的连接不到一半就减小limit，并关闭空闲的连接
+    async def adapt(self):
+        waits, self._waits = sorted(self._waits), []
+        peak, self.peak = self.peak, self.in_use
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0.0
+        grow_wait = self.adaptive.get('grow_wait', 0.02)
+        step = self.adaptive.get('step', 2)
+        old = self.limit
+        if p95 > grow_wait and self.limit < self.pool.maxsize:
+            self.limit = min(self.pool.maxsize, self.limit + step)
+        elif p95 < grow_wait / 10 and peak < self.limit // 2 and self.limit > self.pool.minsize:
+            self.limit = max(self.pool.minsize, self.limit - step)
+            await self.pool.clear()
+        if self.limit != old:
+            logging.info('pool %s limit: %s -> %s (acquire wait p95: %.1fms, peak: %s)' % (self.name, old, self.limit, p95 * 1000, peak))
+            async with self._cond:
+                self._cond.notify_all()
+
+    def metrics(self):
+        return dict(name=self.name, size=self.size, free=self.freesize, in_use=self.in_use, limit=self.limit,
+                    maxsize=self.pool.maxsize, timeouts=self.timeouts, acquire_wait=self.acquire_wait.summary())
+
+# 一个数据库：写操作使用的主库连接池，以及可选的只读副本连接池
+# select()默认从副本读取，execute()总是写主库
+class Database(object):
+
+    def __init__(self, primary, replicas=(), strategy='round_robin', read_your_writes=1.0, driver=None, name=None):
+        self.name = name or DEFAULT
+        self.driver = driver or drivers.get_driver('mysql')  # 见drivers.py
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy  # 'round_robin'轮流使用副本，'least_busy'选正在使用的连接最少的副本
+        self.read_your_writes = read_your_writes  # 同一请求写入后多少秒内的读取仍然走主库
+        self._next = 0
+
+    def pools(self):
+        return [self.primary] + self.replicas
+
+    # 选择执行查询用的连接池
+    def reader(self):
+        if not self.replicas or _recent_write(self.read_your_writes):
+            return self.primary
+        if self.strategy == 'least_busy':
+            return min(self.replicas, key=lambda p: p.in_use)
+        self._next = (self._next + 1) % len(self.replicas)
+        return self.replicas[self._next]
+
+# 当前请求最近一次写入的时间，用于保证请求能读到自己刚写入的数据
+_written_at = contextvars.ContextVar('orm_written_at', default=None)
+
+def _recent_write(window):
+    t = _written_at.get()
+    return t is not None and time.monotonic() - t < window
+
+# 各表的缓存最近一次因为写操作失效的时间
+# 失效之后read_your_writes秒内，任何请求填充缓存的查询都读主库，否则可能从落后的副本读到旧数据，再按新版本写回缓存
+_invalidated_at = {}
+
+def _fill_from_primary(table, database=None):
+    t = _invalidated_at.get(table)
+    return t is not None and time.monotonic() - t < _database(database).read_your_writes
+
+# 按名字登记的数据库，Model通过__database__选择；DEFAULT是configs.db本身配置的数据库
+DEFAULT = 'default'
+_databases = {}
+
+# 取得名为name的数据库；没有单独配置的名字使用默认数据库，
+# 所以Model可以先声明__database__，等数据量上来再在配置里把它指到单独的服务器
+# 分片的数据库没有单独的连接池，要用Model.database_for()按分片键取得某一个分片的名字
+def _database(name=None):
+    db = _databases.get(name or DEFAULT)
+    if db is None:
+        if name in _shard_rings:
+            raise ValueError('database %s is sharded, use Model.database_for() to choose a shard' % name)
+        db = _databases.get(DEFAULT)
+        if db is None:
+            raise RuntimeError('database connection pool is not created, call create_pool() first')
+    return db
+
+# 创建一个数据库的连接池(以及它的只读副本)，登记为name
+async def _create_database(loop, name, kw):
+    prefix = '' if name == DEFAULT else name + '.'
+    driver = drivers.get_driver(kw.get('driver', 'mysql'))
+    adaptive = kw.get('adaptive') or None
+    if adaptive is not None and not adaptive.get('enabled', True):
+        adaptive = None
+    def wrap(pool, pool_name):
+        return Pool(pool, prefix + pool_name, kw.get('acquire_timeout'), adaptive)
+    #调用一个自协程创建全局的连接池，create_pool的返回值是一个pool实例对象
+    primary = wrap(await driver.create_pool(loop, kw), 'primary')
+    replicas = []
+    for i, r in enumerate(kw.get('replicas') or ()):
+        opts = dict(kw)
+        opts.update(r)
+        logging.info('create replica connection pool: %s:%s' % (opts.get('host', 'localhost'), opts.get('port', 3306)))
+        replicas.append(wrap(await driver.create_pool(loop, opts), 'replica-%s' % i))
+    db = Database(primary, replicas, kw.get('replica_strategy', 'round_robin'), kw.get('read_your_writes', 1.0), driver, name)
+    _databases[name] = db
+    if adaptive is not None:
+        (loop or asyncio.get_event_loop()).create_task(_adapt_forever(db, adaptive.get('interval', 10)))
+    return db
+
+# 分片数据库名 -> ShardRing
+_shard_rings = {}
+
+# 一致性哈希环：每个分片在环上放replicas个虚拟节点，值落在环上顺时针遇到的第一个节点所属的分片
+# 增加一个分片时只有约1/N的值换到新的分片上，而不是像取模那样几乎全部换位置
+class ShardRing(object):
+
+    def __init__(self, names, replicas=100):
+        self.names = list(names)
+        ring = sorted((self._hash('%s#%d' % (name, i)), name) for name in self.names for i in range(replicas))
+        self._keys = [h for h, _ in ring]
+        self._nodes = [name for _, name in ring]
+
+    @staticmethod
+    def _hash(s):
+        return int(hashlib.md5(s.encode('utf-8')).hexdigest()[:16], 16)
+
+    # 返回value所在分片的数据库名
+    def get(self, value):
+        i = bisect.bisect(self._keys, self._hash(str(value)))
+        return self._nodes[i % len(self._nodes)]
+
 # 创建全局连接池
 # 这个函数将来会在app.py的init函数中引用
 # 目的是为了让每个HTTP请求都能从连接池中直接获取数据库连接
 # 避免了频繁关闭和打开数据库连接
 # 关键字参数允许传入0个或任意个含参数名的参数，这些关键字参数在函数内部自动组装为一个dict
+# replicas是只读副本的参数list，每一项只需写出与主库不同的参数，比如[{'host': '10.0.0.2'}]
+# replica_strategy和read_your_writes见Database
+# minsize、maxsize是连接数的范围，acquire_timeout是取连接的超时秒数
+# adaptive=dict(enabled=True, interval=10, grow_wait=0.02, step=2)时在minsize和maxsize之间自动调整，见Pool.adapt()
+# query_cache=dict(size=512, ttl=30, max_rows=1000)是查询缓存的参数，见QueryCache
+# slow_query=dict(threshold=0.2, explain_interval=60, file='slow_query.log')：耗时超过threshold秒的语句连同EXPLAIN写入慢查询日志
+# driver='mysql'(默认)或'sqlite'，使用sqlite时path是数据库文件，不需要host、user等参数
+# request_connections是一个请求通过gather()最多同时占用的连接数
+# databases是其他命名数据库的参数dict，比如{'comments': {'host': '10.0.0.3'}}，每一项只需写出与默认数据库不同的参数，
+# 但不继承默认数据库的replicas；声明了__database__ = 'comments'的Model使用该数据库
+# 其中一项带shards时，比如{'comments': {'shards': [{'host': '10.0.0.3'}, {'host': '10.0.0.4'}]}}，
+# 每个分片是一个名为'comments.0'、'comments.1'...的数据库，Model的行按__shard_key__的一致性哈希分布到各分片
 async def create_pool(loop, **kw):
-	logging.info('create database connection pool...')
-	# 声明变量__pool是一个全局变量，如果不加声明，__pool就会被默认为一个私有变量，不能被其他函数引用
-	global __pool
-	#调用一个自协程创建全局的连接池，create_pool的返回值是一个pool实例对象
-	__pool = await aiomysql.create_pool(
-	#dict的get方法，如果dict中有对应的value值，则返回对应于key的value值，否则返回默认值
-	#例如下面的host，如果dict里面没有'host',则返回后面的默认值，也就是'localhost'
-		host = kw.get('host', 'localhost'),
-		port = kw.get('port', 3306),
-		user = kw['user'],
-		password = kw['password'],
-		db = kw['db'],
-		charset = kw.get('charset','utf8'),
-		autocommit = kw.get('autocommit',True),#默认自动提交事务，不用手动去提交事务
-		maxsize = kw.get('maxsize',10),
-		minsize = kw.get('minsize',1),
-		loop = loop# 传递消息循环对象，用于异步执行
-	)
+    logging.info('create database connection pool...')
+    global _request_connections
+    _request_connections = kw.get('request_connections', _request_connections)
+    query_cache.configure(**(kw.get('query_cache') or {}))
+    slow = dict(kw.get('slow_query') or {})
+    filename = slow.pop('file', None)
+    _slow_query.update(slow)
+    if filename and not slow_log.handlers:
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.propagate = False
+    await _create_database(loop, DEFAULT, kw)
+    for name, r in (kw.get('databases') or {}).items():
+        opts = dict((k, v) for k, v in kw.items() if k not in ('databases', 'replicas'))
+        opts.update(r)
+        shards = opts.pop('shards', None)
+        if not shards:
+            logging.info('create connection pool of database %s...' % name)
+            await _create_database(loop, name, opts)
+            continue
+        names = []
+        for i, shard in enumerate(shards):
+            shard_opts = dict(opts)
+            shard_opts.update(shard)
+            names.append('%s.%d' % (name, i))
+            logging.info('create connection pool of database %s...' % names[-1])
+            await _create_database(loop, names[-1], shard_opts)
+        _shard_rings[name] = ShardRing(names)
+
+async def _adapt_forever(db, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for pool in db.pools():
+            try:
+                await pool.adapt()
+            except Exception as e:
+                logging.exception(e)
+
+# 返回连接池和各SQL模板耗时的统计，供管理接口展示
+def metrics():
+    return dict(pools=[p.metrics() for db in _databases.values() for p in db.pools()],
+                queries=dict((sql, h.summary()) for sql, h in query_stats.items()),
+                query_cache=query_cache.stats(),
+                write_buffers=[b.stats() for b in _write_buffers.values()])
+
+# 按Model的定义建表(已存在的表和索引不变)，用于SQLite数据库或新的MySQL数据库
+# 每个表建在它的Model的__database__里，分片的Model在每个分片上各建一张表
+async def create_tables(*models):
+    for cls in models:
+        for database in cls._shards():
+            for sql in _database(database).driver.create_table(cls):
+                await execute(sql, None, database=database)
+
+# =================================以下是事务处理区====================================
+
+# 当前协程(请求)所在的事务，数据库名 -> Transaction，没有事务时为None
+# 每个数据库各自有独立的事务，跨数据库的写操作不是原子的
+_tx = contextvars.ContextVar('orm_transaction', default=None)
+
+# 当前请求在database上的事务，没有时返回None
+def _current_tx(database=None):
+    txs = _tx.get()
+    return txs.get(_database(database).name) if txs else None
+
+# 事务对象：固定的连接，以及提交成功后才执行的回调(缓存失效、计数调整等)
+class Transaction(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.callbacks = []
+
+# 用法：async with orm.transaction() as tx: ...
+# 从连接池中取出一个连接固定下来，块内所有select()、execute()以及Model的方法都使用这个连接
+# 正常退出时提交一次，出现异常时回滚；嵌套使用时并入最外层的事务
+# database是数据库名，默认数据库之外的Model要用orm.transaction(Model.__database__)，
+# 分片的Model要用orm.transaction(Model.database_for(分片键的值))
+@contextlib.asynccontextmanager
+async def transaction(database=None):
+    tx = _current_tx(database)
+    if tx is not None:
+        yield tx
+        return
+    db = _database(database)
+    async with _request_slot(), db.primary.get() as conn:
+        tx = Transaction(conn)
+        txs = dict(_tx.get() or {})
+        txs[db.name] = tx
+        token = _tx.set(txs)
+        await conn.begin()
+        try:
+            yield tx
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            _tx.reset(token)
+    for fn in tx.callbacks:
+        fn()
+
+def in_transaction(database=None):
+    return _current_tx(database) is not None
+
+# 在database上的事务中时，等事务提交后再调用fn；不在事务中时立即调用
+def after_commit(fn, database=None):
+    tx = _current_tx(database)
+    if tx is None:
+        fn()
+    else:
+        tx.callbacks.append(fn)
+
+# 取得执行SQL用的连接：在事务中时返回事务固定的连接，否则从database的连接池中取一个
+# read为True时可以使用只读副本
+@contextlib.asynccontextmanager
+async def _connect(read=False, database=None):
+    tx = _current_tx(database)
+    if tx is not None:
+        yield tx.conn
+    else:
+        db = _database(database)
+        pool = db.reader() if read else db.primary
+        async with _request_slot(), pool.get() as conn:
+            yield conn
+
+# =================================以下是并发查询区====================================
+
+# 当前请求可以同时使用的连接数，gather()第一次调用时创建，同一请求里的并发查询共用
+_request_slots = contextvars.ContextVar('orm_request_slots', default=None)
+_request_connections = 3  # 一个请求最多同时占用几个连接，create_pool()的request_connections参数
+
+# 取连接前先占用当前请求的一个名额；没有调用过gather()的请求只会顺序查询，不受限制
+@contextlib.asynccontextmanager
+async def _request_slot():
+    slots = _request_slots.get()
+    if slots is None:
+        yield
+    else:
+        async with slots:
+            yield
+
+# 并发执行互不依赖的查询，每个查询使用各自的连接，按参数顺序返回结果，任何一个出错时取消其他的
+# 例如 blog, comments = await orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id]))
+# 同一个请求同时占用的连接不超过request_connections个，一个请求不会占满连接池
+# 在事务中只有一个连接，按顺序执行
+async def gather(*aws):
+    if _tx.get():
+        return [await aw for aw in aws]
+    if _request_slots.get() is None:
+        _request_slots.set(asyncio.Semaphore(_request_connections))
+    # 在设置了_request_slots之后创建task，task复制当前的context，和本请求共用名额
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        raise
 
 # =================================以下是SQL函数处理区====================================
 
+# 正在执行的查询，(sql, args, size) -> Future，用于合并并发的相同查询
+_inflight = {}
+
 #执行SELECT语句。使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击
 # sql参数即为sql语句，args表示要搜索的参数
 # size用于指定最大的查询数量，不指定将返回所有查询结果
-async def select(sql, args, size = None):
+# coalesce为True时，如果已有相同(sql, args, size)的查询在执行，就直接等待它的结果而不再占用新的连接
+# 合并后多个调用者拿到的是同一个list，调用者不应修改返回的行；事务中的查询不会被合并
+# tuples为True时每行是按select列顺序排列的tuple，省去DictCursor为每行构造dict的开销
+# database是数据库名，Model的方法传入自己的__database__，默认使用默认数据库
+# generation是调用者读到的缓存版本号，结果要写入缓存时传入：只合并在同一个版本下开始的查询，
+# 否则失效之后的调用者会等到失效之前开始的查询的旧结果，再把它按新版本写回缓存
+# primary为True时不使用只读副本
+async def select(sql, args, size = None, coalesce = True, tuples = False, database = None, generation = None, primary = False):
+    if not coalesce or _current_tx(database) is not None:
+        return await _select(sql, args, size, tuples, database, primary)
+    db = _database(database)
+    # 刚写入过的请求要读主库，不能和读副本的查询合并
+    key = (db.name, sql, tuple(args or ()), size, tuples, primary or _recent_write(db.read_your_writes), generation)
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_select(sql, args, size, tuples, database, primary))
+        _inflight[key] = fut
+        fut.add_done_callback(lambda f: _inflight.pop(key, None))
+    else:
+        logging.info('SQL coalesced: %s' % sql)
+    # shield使某个调用者被取消时，不影响其他等待同一结果的调用者
+    return await asyncio.shield(fut)
+
+async def _select(sql, args, size = None, tuples = False, database = None, primary = False):
     log(sql, args)
-    global __pool
+    driver = _database(database).driver
     # 用with语句可以封装清理（关闭conn)和处理异常工作
     #with 语句将该方法的返回值赋值给 as 子句中的 target
-    # 从连接池中获得一个数据库连接
-    async with __pool.get() as conn:
-    # 使用cursor()方法获取操作游标,cursor返回格式为字典格式，默认以列表list表示
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-        #SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换
+    # 从连接池中获得一个数据库连接(在事务中时是事务固定的连接，否则优先使用只读副本)
+    start = time.monotonic()
+    async with _connect(read=not primary, database=database) as conn:
+        wait = time.monotonic() - start  # 取连接的等待时间
+    # 使用cursor()方法获取操作游标,cursor返回格式为字典格式(tuples为True时为tuple)，默认以列表list表示
+        async with conn.cursor(driver.cursor_type(drivers.TUPLE if tuples else drivers.DICT)) as cur:
+        #SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部通过驱动自动替换
         # 使用execute方法执行SQL语句args
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            start = time.monotonic()
+            await cur.execute(driver.sql(sql), args or ())
             if size:
                 # 使用 fetchmany() 方法每次读取size的数据量。
                 rs = await cur.fetchmany(size)
             else:
                 #否则，通过fetchall()获取所有记录
                 rs = await cur.fetchall()
+            _profile(sql, args, time.monotonic() - start, len(rs), wait, database)
+            if not sql.startswith('explain '):  # advise()自己执行的EXPLAIN不作为样本
+                query_samples[_template(sql)] = (sql, args, database)
         logging.info('rows returned: %s' % len(rs))
         return rs
 
+# 与select()相同，但使用不缓冲的服务端游标(SSDictCursor)，每次读取batch行并产出
+# 行在MySQL端按需读取，内存占用与表的大小无关
+# 在事务中使用时，迭代结束前不能在同一事务里执行其他语句
+async def select_iter(sql, args, batch=100, database=None):
+    log(sql, args)
+    driver = _database(database).driver
+    async with _connect(read=True, database=database) as conn:
+        async with conn.cursor(driver.cursor_type(drivers.STREAM)) as cur:
+            await cur.execute(driver.sql(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                yield rs
+
 #要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数
 #因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数
-async def execute(sql, args, autocommit=True):
+# 在transaction()中调用时，由事务统一提交，autocommit参数不起作用
+async def execute(sql, args, autocommit=True, database=None):
     log(sql)
-    async with __pool.get() as conn:
+    if _current_tx(database) is not None:
+        autocommit = True
+    driver = _database(database).driver
+    start = time.monotonic()
+    async with _connect(database=database) as conn:
+        wait = time.monotonic() - start
         if not autocommit:
             await conn.begin()
         try:
             # execute类型sql操作返回结果只有行号，不需要dict
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            async with conn.cursor(driver.cursor_type(drivers.DICT)) as cur:
+                start = time.monotonic()
+                await cur.execute(driver.sql(sql), args)
                 affected = cur.rowcount
+                _profile(sql, args, time.monotonic() - start, affected, wait, database)
+            _written_at.set(time.monotonic())  # 之后一段时间内本请求的查询走主库
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
@@ -88,6 +683,15 @@ async def execute(sql, args, autocommit=True):
 		#cursor对象不返回结果集，而是通过rowcount返回受影响的行数
         return affected
 
+# 在同一个连接上按顺序执行多条(sql, args)，整体放在一个事务里，任何一条失败都会回滚
+# 返回所有语句受影响的行数之和
+async def execute_batch(statements, database=None):
+    affected = 0
+    async with transaction(database):
+        for sql, args in statements:
+            affected += await execute(sql, args, database=database)
+    return affected
+
 # 这个函数在元类中被引用，作用是创建一定数量的占位符
 def create_args_string(num):
     L = []
@@ -96,17 +700,75 @@ def create_args_string(num):
     #比如说num=3，那L就是['?','?','?']，通过下面这句代码返回一个字符串'?,?,?'
     return ', '.join(L)
 
+# =====================================主键生成区==============================================
+
+# snowflake风格的64位主键：毫秒时间戳 | worker id | 同一毫秒内的序号
+# id按时间递增，InnoDB插入时总是追加在聚簇索引的末尾；bigint比varchar(50)的主键、外键和二级索引都小得多
+# 默认时间戳41位(从EPOCH起可用约69年)、worker 5位、序号7位，共53位，前端JavaScript的Number可以精确表示
+class Snowflake(object):
+
+    EPOCH = 1420070400000  # 2015-01-01 00:00:00 UTC，毫秒，要早于迁移前最老的数据
+
+    def __init__(self, worker_id=0, worker_bits=5, sequence_bits=7, epoch=EPOCH):
+        if not 0 <= worker_id < (1 << worker_bits):
+            raise ValueError('worker_id must be in [0, %d)' % (1 << worker_bits))
+        self.worker_id = worker_id
+        self.sequence_bits = sequence_bits
+        self.timestamp_shift = worker_bits + sequence_bits
+        self.epoch = epoch
+        self._sequence_mask = (1 << sequence_bits) - 1
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    # 生成下一个id，now是毫秒时间戳，默认取当前时间；迁移旧数据时传入旧id里的时间戳
+    def next_id(self, now=None):
+        with self._lock:
+            if now is None:
+                now = int(time.time() * 1000)
+            if now < self._last:  # 时钟回拨或传入的时间更早，沿用上次的时间戳，保证id单调递增
+                now = self._last
+            if now == self._last:
+                self._sequence = (self._sequence + 1) & self._sequence_mask
+                if self._sequence == 0:  # 这一毫秒的序号用完了，借用下一毫秒
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last = now
+            return ((now - self.epoch) << self.timestamp_shift) | (self.worker_id << self.sequence_bits) | self._sequence
+
+    # id生成时的时间戳(秒)
+    def timestamp(self, id):
+        return ((int(id) >> self.timestamp_shift) + self.epoch) / 1000.0
+
+_ids = Snowflake()
+
+# 每个进程要用不同的worker id，否则同一毫秒内可能生成相同的id
+def configure_ids(worker_id=0, **kw):
+    global _ids
+    _ids = Snowflake(worker_id, **kw)
+
+def next_id():
+    return _ids.next_id()
+
 # =====================================Field定义域区==============================================
 # 首先来定义Field类，它负责保存数据库表的字段名和字段类型
 
 # 父定义域，可以被其他定义域继承
 class Field(object):
     # 定义域的初始化，包括属性（列）名，属性（列）的类型，主键，默认值
-    def __init__(self, name, column_type, primary_key, default):
+    # index=True为该列建普通索引，unique=True建唯一索引
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default  # 如果存在默认值，在getOrDefault()中会被用到
+        self.index = index
+        self.unique = unique
+
+    # 把url、cookie里传来的值转换成该字段在数据库中的类型，find()和batchFind()用它作为缓存的key
+    def to_key(self, value):
+        return value
 
     # 定制输出信息为 类名，列的类型，列名
     def __str__(self):
@@ -116,29 +778,522 @@ class Field(object):
 class StringField(Field):
     #ddl是数据定义语言("data definition languages")，默认值是'varchar(100)'，意思是可变字符串，长度为100
     #和char相对应，char是固定长度，字符串长度不够会自动补齐，varchar则是多长就是多长，但最长不能超过规定长度
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
 		#子类重写了父类中同名方法__init__，在重写的实现中通过super实例化的代理对象调用父类的同名方法
-        super().__init__(name, ddl, primary_key, default)
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index, unique)
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, ddl='text'):
+        super().__init__(name, ddl, False, default)
+
+# snowflake主键，以及引用它的外键，如blog_id、user_id
+class IdField(Field):
+
+    def __init__(self, name=None, primary_key=False, default=None, index=False):
+        super().__init__(name, 'bigint unsigned', primary_key, default, index)
+
+    def to_key(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value  # 不是数字的id查不到任何行，交给调用者按不存在处理
+
+# 二级索引或联合索引，在Model子类中声明：__indexes__ = [Index('blog_id', 'created_at')]
+# 只有一列的索引也可以直接写在Field上：StringField(index=True)或StringField(unique=True)
+class Index(object):
+
+    def __init__(self, *columns, unique=False, name=None):
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name or 'idx_%s' % '_'.join(columns)
+
+    def ddl(self):
+        return '%skey `%s` (%s)' % ('unique ' if self.unique else '', self.name, ', '.join('`%s`' % c for c in self.columns))
+
+    def __str__(self):
+        return '<Index %s(%s)%s>' % (self.name, ', '.join(self.columns), ' unique' if self.unique else '')
+
+# =====================================索引建议区==========================================
+
+_RE_WHERE = re.compile(r' where (.+?)(?: order by | limit |$)')
+_RE_ORDER = re.compile(r' order by (.+?)(?: limit |$)')
+_RE_CONDITION = re.compile(r'`?(\w+)`?\s*(?:=|<|>|\s+in\s*\()')
+_RE_COLUMN = re.compile(r'`?(\w+)`?(?:\s+(?:asc|desc))?')
+
+# 从SQL模板里找出where条件和order by用到的列，作为建索引的建议
+def _suggest_columns(sql):
+    columns = []
+    m = _RE_WHERE.search(sql)
+    if m:
+        columns.extend(_RE_CONDITION.findall(m.group(1)))
+    m = _RE_ORDER.search(sql)
+    if m:
+        columns.extend(_RE_COLUMN.match(part.strip()).group(1) for part in m.group(1).split(','))
+    return list(collections.OrderedDict.fromkeys(c for c in columns if c.lower() not in ('and', 'or', 'not')))
+
+# 对应用实际执行过的SELECT模板执行EXPLAIN，报告全表扫描、filesort和临时表，并给出建索引的建议
+# models不为空时，再用show index比较Model声明的索引和数据库里实际的索引，报告缺少的索引
+# 注意：表里行数很少时MySQL可能有索引也选择全表扫描
+async def advise(models=()):
+    report = []
+    for template, (sql, args, database) in list(query_samples.items()):
+        try:
+            rs = await select(_database(database).driver.explain_prefix + sql, args, coalesce=False, database=database)
+        except Exception as e:
+            report.append(dict(sql=template, error=str(e)))
+            continue
+        for r in rs:
+            problems = []
+            extra = r.get('Extra') or ''
+            detail = r.get('detail') or ''  # SQLite的explain query plan只有detail一列
+            if r.get('type') == 'ALL':
+                problems.append('full table scan on `%s` (rows: %s)' % (r.get('table'), r.get('rows')))
+            if detail.startswith('SCAN ') and ' USING ' not in detail:
+                problems.append('full table scan: %s' % detail)
+            if 'Using filesort' in extra or 'TEMP B-TREE FOR ORDER BY' in detail:
+                problems.append('filesort')
+            if 'Using temporary' in extra or 'TEMP B-TREE FOR GROUP BY' in detail or 'TEMP B-TREE FOR DISTINCT' in detail:
+                problems.append('temporary table')
+            if problems:
+                columns = _suggest_columns(sql)
+                report.append(dict(sql=template, table=r.get('table'), key=r.get('key'), problems=problems,
+                                   suggestion='Index(%s)' % ', '.join(repr(c) for c in columns) if columns else None))
+    for cls in models:
+        for database in cls._shards():
+            driver = _database(database).driver
+            sql = driver.index_names_sql(cls)
+            existing = set(r['name'] for r in await select(sql, None, coalesce=False, database=database))
+            query_samples.pop(_template(sql), None)  # 不是应用的查询，下次不用EXPLAIN
+            for idx in cls.__indexes__:
+                if driver.index_name(cls, idx) not in existing:
+                    report.append(dict(table=cls.__table__, database=database, problems=['declared index missing in database'], suggestion=idx.ddl()))
+    return report
+
+# =====================================行缓存区==========================================
+
+# 缓存中表示"数据库里没有这个主键"的标记，用于负缓存，避免反复查询不存在的行
+_MISSING = object()
+
+# 按主键缓存数据库行的LRU缓存，在Model子类中通过__cache__ = dict(size=..., ttl=...)开启
+# find()先查缓存，save()、update()、remove()会让对应主键的缓存失效
+class RowCache(object):
+
+    def __init__(self, size=1024, ttl=60, negative_ttl=None):
+        self.size = size  # 最多缓存多少行，超出后淘汰最久未使用的
+        self.ttl = ttl  # 缓存行的存活秒数
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl  # 负缓存的存活秒数
+        self.version = 0  # 每次失效加1，防止并发查询把旧数据写回缓存
+        self.hits = 0
+        self.misses = 0
+        self._rows = collections.OrderedDict()
+
+    # 命中返回行(dict)，命中负缓存返回_MISSING，未命中或已过期返回None
+    def get(self, pk):
+        entry = self._rows.get(pk)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                del self._rows[pk]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(pk)
+        self.hits += 1
+        return entry[1]
+
+    # row为None表示数据库里没有这一行；version是查询前读取的self.version
+    def put(self, pk, row, version=None):
+        if version is not None and version != self.version:
+            return
+        if row is None:
+            entry = (time.time() + self.negative_ttl, _MISSING)
+        else:
+            entry = (time.time() + self.ttl, dict(row))
+        self._rows[pk] = entry
+        self._rows.move_to_end(pk)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, pk):
+        self.version += 1
+        self._rows.pop(pk, None)
+
+    def clear(self):
+        self.version += 1
+        self._rows.clear()
+
+# =====================================查询缓存区==========================================
+
+# 缓存findAll()、findRecords()、findNumber()的查询结果，key是(SQL模板, 参数)
+# 每个表有一个版本号，save()、update()、remove()让该表的版本号加1，旧版本的结果全部失效
+# 所以blogs表的写入只会让blogs上的查询失效，不影响其他表；在Model子类中通过__query_cache__ = True开启
+class QueryCache(object):
+
+    def __init__(self, size=512, ttl=30, max_rows=1000):
+        self.size = size  # 最多缓存多少条查询结果，超出后淘汰最久未使用的
+        self.ttl = ttl  # 结果的存活秒数，兜底其他进程的写入
+        self.max_rows = max_rows  # 行数超过它的结果不缓存
+        self.versions = collections.Counter()  # 表名 -> 版本号
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # (表名, key) -> (版本号, 过期时间, 结果)
+
+    def configure(self, size=None, ttl=None, max_rows=None):
+        if size is not None:
+            self.size = size
+        if ttl is not None:
+            self.ttl = ttl
+        if max_rows is not None:
+            self.max_rows = max_rows
+        self.clear()
+
+    # 命中返回结果，未命中、已过期或表版本已变化返回None
+    def get(self, table, key):
+        k = (table, key)
+        entry = self._entries.get(k)
+        if entry is None or entry[0] != self.versions[table] or entry[1] < time.time():
+            if entry is not None:
+                del self._entries[k]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(k)
+        self.hits += 1
+        return entry[2]
+
+    # version是查询前读取的版本号，查询期间表被写入时不缓存
+    def put(self, table, key, rs, version):
+        if version != self.versions[table] or len(rs) > self.max_rows:
+            return
+        k = (table, key)
+        self._entries[k] = (version, time.time() + self.ttl, rs)
+        self._entries.move_to_end(k)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    # 表有写入，该表上所有缓存的结果失效(在下次get时删除)
+    def bump(self, table):
+        self.versions[table] += 1
+
+    def clear(self):
+        for table in self.versions:
+            self.versions[table] += 1
+        self._entries.clear()
+
+    def stats(self):
+        return dict(entries=len(self._entries), hits=self.hits, misses=self.misses)
+
+query_cache = QueryCache()
+
+# =====================================计数区==========================================
+
+# 在内存里维护各表(以及按where条件)的行数，代替每个请求都执行一次select count(id)
+# 第一次读取时从数据库查询，save()/remove()时加减，reconcile()定期和数据库对账
+# 带where的计数无法判断新写入的行是否满足条件，所以表有写入时直接丢弃，下次读取重新查询
+class CountCache(object):
+
+    def __init__(self):
+        self._counts = {}  # (表名, where, args) -> 行数
+        self._models = {}  # (表名, where, args) -> Model子类，对账时使用
+
+    async def get(self, cls, where=None, args=None):
+        key = (cls.__table__, where, tuple(args or ()))
+        n = self._counts.get(key)
+        if n is None:
+            n = await self._query(cls, where, args)
+            self._counts[key] = n
+            self._models[key] = cls
+        return n
+
+    async def _query(self, cls, where, args):
+        return await cls.findNumber('count(`%s`)' % cls.__primary_key__, where, list(args or ()), cache=False) or 0
+
+    # 预先查询好一批表的总行数，在应用启动时调用
+    async def seed(self, *models):
+        for cls in models:
+            self._counts.pop((cls.__table__, None, ()), None)
+            await self.get(cls)
+
+    # 表中增加(delta>0)或删除(delta<0)了行
+    def adjust(self, table, delta):
+        for key in list(self._counts):
+            if key[0] != table:
+                continue
+            if key[1] is None:
+                self._counts[key] += delta
+            else:
+                del self._counts[key]
+                del self._models[key]
+
+    # 不知道表中增减了多少行(比如upsert)，删掉该表所有的计数，下次count()时重新查询
+    def forget(self, table):
+        for key in list(self._counts):
+            if key[0] == table:
+                del self._counts[key]
+                del self._models[key]
+
+    # 重新查询所有计数，修正其他进程写入或调整遗漏造成的偏差
+    async def reconcile(self):
+        for key, cls in list(self._models.items()):
+            n = await self._query(cls, key[1], key[2])
+            if key in self._counts and self._counts[key] != n:
+                logging.info('count of %s (%s) reconciled: %s -> %s' % (key[0], key[1], self._counts[key], n))
+                self._counts[key] = n
+
+    def clear(self):
+        self._counts.clear()
+        self._models.clear()
+
+counts = CountCache()
+
+# 启动一个后台任务，每interval秒对账一次，返回该任务
+def start_count_reconciler(loop, interval=300):
+    async def reconcile_forever():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await counts.reconcile()
+            except Exception as e:
+                logging.exception(e)
+    return loop.create_task(reconcile_forever())
+
+# =====================================批量加载区==========================================
+
+# 把同一轮事件循环里按同一个字段(外键或主键)对同一个Model的多次查询合并成一条where `字段` in (...)
+# 用于避免N+1查询：例如为一页博客分别取评论时，各个await会在下一轮循环里一起查询
+# 通过Model.batchFind()、Model.batchFindAll()使用
+class BatchLoader(object):
+
+    MAX_KEYS = 500  # 一条IN查询最多带多少个值
+
+    def __init__(self, cls, column, orderBy=None):
+        self.cls = cls
+        self.column = column
+        self.orderBy = orderBy
+        self._pending = {}  # 字段值 -> Future，结果是该值对应的行(tuple)的list
+        self._counters = []  # 参与这一批的请求的QueryCounter
+
+    # 返回一个Future，下一轮循环查询完成后得到该值对应的行
+    def load(self, value):
+        fut = self._pending.get(value)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                # 在空的context中执行，批量查询不属于任何一个调用者的事务
+                loop.call_soon(self._dispatch, context=contextvars.Context())
+            fut = loop.create_future()
+            self._pending[value] = fut
+        _join_counter(self._counters)
+        return fut
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        counters, self._counters = self._counters, []
+        asyncio.ensure_future(self._run(pending, counters))
+
+    async def _run(self, pending, counters):
+        _count_for(counters)
+        cls = self.cls
+        keys = list(pending)
+        index = cls._column_names().index(self.column)
+        groups = dict((k, []) for k in keys)
+        try:
+            for i in range(0, len(keys), self.MAX_KEYS):
+                # 分片的Model按分片分别查询，各分片的查询同时执行
+                queries = []
+                for database, chunk in cls._partition(self.column, keys[i:i + self.MAX_KEYS]):
+                    sql, args, _ = cls._select_sql('`%s` in (%s)' % (self.column, create_args_string(len(chunk))), chunk, orderBy=self.orderBy)
+                    queries.append(select(sql, args, coalesce=cls.__coalesce__, tuples=True, database=database))
+                for rs in (await gather(*queries) if len(queries) > 1 else [await queries[0]]):
+                    for r in rs:
+                        groups.setdefault(r[index], []).append(r)
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for k, fut in pending.items():
+            if not fut.done():
+                fut.set_result(groups[k])
+
+_loaders = {}
+
+def _loader(cls, column, orderBy=None):
+    key = (cls, column, orderBy)
+    loader = _loaders.get(key)
+    if loader is None:
+        loader = _loaders[key] = BatchLoader(cls, column, orderBy)
+    return loader
+
+# =====================================写缓冲区==========================================
+
+# 把短时间内对同一个Model的多次save()合并成一条多行INSERT，在一个事务里提交，一批只需一次fsync
+# 在Model子类中通过__write_buffer__ = dict(delay=0.005, size=100)开启：
+# 第一个save()之后最多等delay秒，或者攒够size行就写入；save()等到这一批提交之后才返回
+# 整批插入失败时逐行重试，只有出错的那一行的save()抛出异常；事务中的save()不经过缓冲
+class WriteBuffer(object):
+
+    def __init__(self, cls, database, delay=0.005, size=100):
+        self.cls = cls
+        self.database = database
+        self.delay = delay
+        self.size = size
+        self.flushes = 0  # 写入了多少批
+        self.rows = 0  # 写入了多少行
+        self._pending = []  # (对象, Future)
+        self._counters = []  # 参与这一批的请求的QueryCounter
+        self._timer = None
+        self._writing = set()  # 正在写入的批次的task
+
+    # 返回一个Future，obj所在的一批提交之后完成
+    def add(self, obj):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.append((obj, fut))
+        _join_counter(self._counters)
+        if len(self._pending) == self.size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.delay)
+        return fut
+
+    # 在空的context中写入，这一批不属于任何一个调用者的事务和请求
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_later(delay, self.flush, context=contextvars.Context())
+
+    # 立即写入已经缓冲的行
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        counters, self._counters = self._counters, []
+        if pending:
+            task = asyncio.ensure_future(self._write(pending, counters))
+            self._writing.add(task)
+            task.add_done_callback(self._writing.discard)
+
+    async def _write(self, pending, counters):
+        _count_for(counters)
+        try:
+            # 同一轮循环里超过size行的save()仍然在一个事务里提交，每size行一条INSERT
+            await self.cls.save_many([obj for obj, _ in pending], self.size)
+        except Exception as e:
+            if len(pending) == 1:
+                self._done(pending[0][1], e)
+                return
+            logging.warn('buffered insert into %s failed, retry row by row: %s' % (self.cls.__table__, e))
+            for obj, fut in pending:
+                try:
+                    await obj._insert()
+                except Exception as e:
+                    self._done(fut, e)
+                else:
+                    self._done(fut)
+            return
+        self.flushes += 1
+        self.rows += len(pending)
+        for _, fut in pending:
+            self._done(fut)
+
+    # 调用者可能已经取消了等待(比如请求被中断)，这时行仍然会写入
+    @staticmethod
+    def _done(fut, e=None):
+        if fut.done():
+            return
+        if e is None:
+            fut.set_result(None)
+        else:
+            fut.set_exception(e)
+
+    def stats(self):
+        return dict(table=self.cls.__table__, database=self.database, flushes=self.flushes, rows=self.rows, pending=len(self._pending))
+
+_write_buffers = {}
+
+def _write_buffer(cls, database):
+    key = (cls, database)
+    buf = _write_buffers.get(key)
+    if buf is None:
+        buf = _write_buffers[key] = WriteBuffer(cls, database, **cls.__write_buffer__)
+    return buf
+
+# 写入所有缓冲中的行，并等待它们和正在写入的批次完成；app.py在退出前调用
+async def flush_writes():
+    tasks = []
+    for buf in _write_buffers.values():
+        buf.flush()
+        tasks.extend(buf._writing)
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# =====================================Record区==========================================
+
+# Record是查询结果的紧凑表示：每个Model子类由元类生成一个对应的Record子类，用__slots__保存字段，
+# 没有每行一个dict的开销，构造函数按__select__的列顺序接收参数
+# 只用于只读的列表(首页、分页接口等)，保留了模板和JSON需要的[]、get()、keys()等dict风格的接口
+class Record(object):
+    __slots__ = ()
+    __names__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    # 查询了哪些字段，columns/defer跳过的字段不在其中
+    def keys(self):
+        return [n for n in self.__names__ if hasattr(self, n)]
+
+    def items(self):
+        return [(n, getattr(self, n)) for n in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self.__names__ and hasattr(self, key)
+
+    # 转换为dict，用于序列化为JSON
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
+    # 由只包含部分字段的(字段名, 值)序列构造，没有查询的字段保持未赋值
+    @classmethod
+    def from_pairs(cls, pairs):
+        obj = cls.__new__(cls)
+        for k, v in pairs:
+            setattr(obj, k, v)
+        return obj
+
+# 生成名为<name>Record的Record子类，names是按查询顺序排列的字段名(主键在最前)
+# 构造函数用exec生成，是逐个赋值slot的普通函数，避免通用构造函数的循环和setattr开销
+def make_record_class(name, names):
+    ns = {}
+    src = 'def __init__(self, %s):\n%s\n' % (', '.join(names), '\n'.join('    self.%s = %s' % (n, n) for n in names))
+    exec(src, ns)
+    return type('%sRecord' % name, (Record,), dict(__slots__=tuple(names), __names__=tuple(names), __init__=ns['__init__']))
 
 # =====================================Model元类区==========================================
 
@@ -199,11 +1354,29 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName  # 表名
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        # 二级索引：__indexes__中声明的，加上Field上index=True或unique=True的列
+        indexes = [Index(k, unique=v.unique) for k, v in mappings.items() if (v.index or v.unique) and not v.primary_key]
+        indexes.extend(attrs.get('__indexes__', ()))
+        for idx in indexes:
+            for c in idx.columns:
+                if c not in mappings:
+                    raise ValueError('Index %s uses unknown field: %s' % (idx.name, c))
+        attrs['__indexes__'] = indexes
+        shardKey = attrs.get('__shard_key__', None)
+        if shardKey is not None and shardKey not in mappings:
+            raise ValueError('Shard key uses unknown field: %s' % shardKey)
+        # 行缓存，__cache__可以是RowCache的参数dict，也可以直接是RowCache实例
+        cache = attrs.get('__cache__', None)
+        if isinstance(cache, dict):
+            cache = RowCache(**cache)
+        attrs['__cache__'] = cache
         # 构造默认的SELECT, INSERT, UPDATE, DELETE语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+        # 紧凑的只读记录类，字段顺序与__select__一致
+        attrs['__record__'] = make_record_class(name, [primaryKey] + fields)
         return type.__new__(cls, name, bases, attrs)
 
 # =====================================Model基类区==========================================
@@ -214,21 +1387,51 @@ class ModelMetaclass(type):
 # ORM映射基类,通过ModelMetaclass元类来构造类
 # Model类可以看作是对所有数据库表操作的基本定义的映射
 class Model(dict, metaclass=ModelMetaclass):
+    # 查询时被延迟加载(没有从数据库读取)的字段，实例上用object.__setattr__覆盖，不会写进dict
+    _deferred = ()
+    # 是否合并并发的相同查询，要求每次都读到最新数据的Model子类可以设为False
+    __coalesce__ = True
+    # 是否缓存findAll()、findRecords()、findNumber()的结果，见QueryCache
+    __query_cache__ = False
+    # 表所在的数据库名，见create_pool()的databases参数；没有单独配置的名字使用默认数据库
+    __database__ = DEFAULT
+    # 分片键：__database__配置了shards时，按这个字段的值选择分片，同一个值的行总在同一个分片上
+    __shard_key__ = None
+    # 对象是从哪个分片读出来的，分片键没有加载时save()、remove()等用它选择分片
+    _shard = None
+    # 写缓冲的参数dict，如dict(delay=0.005, size=100)，开启后save()合并成多行INSERT写入，见WriteBuffer
+    __write_buffer__ = None
+    # 从数据库加载之后被修改过的字段，None表示没有修改，update()只写这些字段
+    _dirty = None
+
     # 这里直接调用了Model的父类dict的初始化方法，把传入的关键字参数存入自身的dict中
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    # 和dict一样也可以传入一个mapping或(key, value)序列
+    # 直接构造的对象还没有和数据库同步，传入的字段都算作修改过
+    def __init__(self, *args, **kw):
+        super(Model, self).__init__(*args, **kw)
+        object.__setattr__(self, '_dirty', set(k for k in self if k in self.__mappings__))
 
     # 获取dict的key
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self._deferred:
+                raise AttributeError(r"'%s' is deferred, call 'await obj.load()' first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     # 设置dict的key的值，通过d.k = v 的方式
     def __setattr__(self, key, value):
         self[key] = value
 
+    # 通过d.k = v或d[k] = v修改字段时，值有变化就记为修改过
+    def __setitem__(self, key, value):
+        if key in self.__mappings__ and self.get(key, _MISSING) != value:
+            if self._dirty is None:
+                object.__setattr__(self, '_dirty', set())
+            self._dirty.add(key)
+        dict.__setitem__(self, key, value)
+
     # 获取某个具体的值即Value,如果不存在则返回None
     def getValue(self, key):
         # getattr(object, name[, default]) 根据name(属性名）返回属性值，默认为None
@@ -252,31 +1455,212 @@ class Model(dict, metaclass=ModelMetaclass):
 
 	# ==============往Model类添加类方法，就可以让所有子类调用类方法=================
 
+    # __database__是分片数据库时返回它的ShardRing，否则返回None
+    @classmethod
+    def _ring(cls):
+        ring = _shard_rings.get(cls.__database__)
+        if ring is not None and cls.__shard_key__ is None:
+            raise RuntimeError('%s uses sharded database %s but has no __shard_key__' % (cls.__name__, cls.__database__))
+        return ring
+
+    # 表所在的所有数据库名：分片的Model是所有分片，否则只有__database__
+    @classmethod
+    def _shards(cls):
+        ring = cls._ring()
+        return ring.names if ring is not None else [cls.__database__]
+
+    # 分片键等于value的行所在的数据库名，用于orm.transaction(Comment.database_for(blog_id))等
+    @classmethod
+    def database_for(cls, value):
+        ring = cls._ring()
+        if ring is None:
+            return cls.__database__
+        return ring.get(cls.__mappings__[cls.__shard_key__].to_key(value))
+
+    # 是否在表所在的任何一个数据库的事务中
+    @classmethod
+    def _in_transaction(cls):
+        return any(in_transaction(database) for database in cls._shards())
+
+    # 按column的值把values分到各个数据库，返回[(数据库名, values), ...]
+    # column是分片键时每个值只查它所在的分片，否则每个分片都要查
+    @classmethod
+    def _partition(cls, column, values):
+        ring = cls._ring()
+        if ring is None:
+            return [(cls.__database__, values)]
+        if column != cls.__shard_key__:
+            return [(database, values) for database in ring.names]
+        parts = collections.OrderedDict()
+        for v in values:
+            parts.setdefault(ring.get(v), []).append(v)
+        return list(parts.items())
+
+    # 查询要发到哪个数据库：where以"分片键=?"开头(之后是and或结束)时取args[0]，也可以用shard=分片键的值直接指定
+    # 返回None表示要查询所有分片再合并结果
+    @classmethod
+    def _route(cls, where, args, kw):
+        ring = cls._ring()
+        if ring is None:
+            return cls.__database__
+        if kw.get('shard', None) is not None:
+            return cls.database_for(kw['shard'])
+        if where and args:
+            m = re.match(r'\s*`?%s`?\s*=\s*\?(\s+and\s|\s*$)' % cls.__shard_key__, where, re.IGNORECASE)
+            if m:
+                return cls.database_for(args[0])
+        return None
+
+    # 合并各分片按同一个order by查出的行(tuple)，返回排好序的list
+    # 只支持按被查询的字段排序，如'created_at desc, id desc'
+    @classmethod
+    def _merge(cls, parts, orderBy, deferred=()):
+        rows = list(itertools.chain.from_iterable(parts))
+        if not orderBy:
+            return rows
+        names = cls._column_names(deferred)
+        keys = []
+        for part in orderBy.split(','):
+            m = re.match(r'\s*`?(\w+)`?(?:\s+(asc|desc))?\s*$', part, re.IGNORECASE)
+            if m is None or m.group(1) not in names:
+                raise ValueError('cannot merge shards ordered by: %s' % orderBy)
+            keys.append((names.index(m.group(1)), (m.group(2) or '').lower() == 'desc'))
+        # 排序是稳定的，从最后一个排序字段开始依次排序
+        for i, desc in reversed(keys):
+            rows.sort(key=lambda r: r[i], reverse=desc)
+        return rows
+
+    # findAll()、findRecords()共用：返回(按select列顺序排列的tuple的list, 被延迟加载的字段, 数据库名)
+    # 查询所有分片时，每个分片取前offset+n行，合并排序后再取第offset行开始的n行，数据库名为None
+    @classmethod
+    async def _find_rows(cls, where, args, kw):
+        cache = kw.get('cache', True)
+        database = cls._route(where, args, kw)
+        if database is not None:
+            sql, args, deferred = cls._select_sql(where, args, **kw)
+            rs = await cls._cached_select(sql, args, tuples=True, cache=cache, database=database)
+        else:
+            limit = kw.get('limit', None)
+            shard_kw = dict(kw)
+            if isinstance(limit, tuple) and len(limit) == 2:
+                shard_kw['limit'] = limit[0] + limit[1]
+            sql, args, deferred = cls._select_sql(where, args, **shard_kw)
+            parts = await gather(*[cls._cached_select(sql, args, tuples=True, cache=cache, database=d) for d in cls._shards()])
+            rs = cls._merge(parts, cls._order_of(kw), deferred)
+            if isinstance(limit, tuple) and len(limit) == 2:
+                rs = rs[limit[0]:limit[0] + limit[1]]
+            elif limit is not None:
+                rs = rs[:limit]
+        if kw.get("before", None) is not None:
+            rs = rs[::-1]
+        return rs, deferred, database
+
+    # _select_sql()实际使用的order by
+    @classmethod
+    def _order_of(cls, kw):
+        after, before = kw.get("after", None), kw.get("before", None)
+        if after is None and before is None:
+            return kw.get("orderBy", None)
+        col, pk = kw.get("keyset", None) or ('created_at', cls.__primary_key__)
+        direction = 'desc' if after is not None else 'asc'
+        return "`%s` %s, `%s` %s" % (col, direction, pk, direction)
+
     @classmethod  # 这个装饰器是类方法的意思，即可以不创建实例直接调用类方法
 	# 类方法有类变量cls传入，从而可以用cls做一些相关的处理。
 	# 并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。
-    async def find(cls, pk):
+    async def find(cls, pk, columns=None, defer=None):
         '''查找对象的主键'''
+        select_sql, deferred = cls._projection(columns, defer)
+        # 事务中可能读到未提交的数据，不使用行缓存
+        cache = cls.__cache__ if not cls._in_transaction() else None
+        pk = cls.__mappings__[cls.__primary_key__].to_key(pk)
+        if cache is not None:
+            row = cache.get(pk)
+            if row is _MISSING:
+                return None
+            if row is not None:
+                return cls._from_row(row)  # 返回副本，调用者修改对象不会影响缓存
+            version = cache.version
         # select函数之前定义过，这里传入了三个参数分别是之前定义的 sql、args、size
-        rs = await select("%s where `%s`=?" % (cls.__select__, cls.__primary_key__), [pk], 1)
+        # 分片的Model不知道主键在哪个分片上，同时查询所有分片
+        sql = "%s where `%s`=?" % (select_sql, cls.__primary_key__)
+        databases = cls._shards()
+        generation = version if cache is not None else None
+        primary = cache is not None and _fill_from_primary(cls.__table__, databases[0])
+        if len(databases) == 1:
+            parts = [await select(sql, [pk], 1, cls.__coalesce__, database=databases[0], generation=generation, primary=primary)]
+        else:
+            parts = await gather(*[select(sql, [pk], 1, cls.__coalesce__, database=d, generation=generation, primary=primary) for d in databases])
+        database, rs = next(((d, p) for d, p in zip(databases, parts) if p), (None, []))
+        if cache is not None and (rs == [] or not deferred):  # 只缓存完整的行
+            cache.put(pk, rs[0] if rs else None, version)
         if len(rs) == 0:
             return None
 		# **rs 是关键字参数，rs接收的是是一个dict，此处为select语句返回的查询结果
-        return cls(**rs[0])
+        return cls._from_row(rs[0], deferred, database)
 
-    # findAll() - 根据WHERE条件查找
+    # 根据columns(只查这些字段)或defer(不查这些字段)算出SELECT语句，主键总会被查询
+    # 返回(select语句, 被延迟加载的字段)
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        # __select__调用后格式为'select `%s`, %s from `%s`'
-        sql = [cls.__select__]
+    def _projection(cls, columns=None, defer=None):
+        if columns is None and not defer:
+            return cls.__select__, ()
+        unknown = (set(columns or ()) | set(defer or ())) - set(cls.__mappings__)
+        if unknown:
+            raise ValueError('unknown field: %s' % ', '.join(sorted(unknown)))
+        fields = [f for f in cls.__fields__ if (columns is None or f in columns) and not (defer and f in defer)]
+        deferred = tuple(f for f in cls.__fields__ if f not in fields)
+        select_sql = 'select `%s`%s from `%s`' % (cls.__primary_key__, ''.join(', `%s`' % f for f in fields), cls.__table__)
+        return select_sql, deferred
+
+    # 按select列的顺序返回查询的字段名
+    @classmethod
+    def _column_names(cls, deferred=()):
+        return [cls.__primary_key__] + [f for f in cls.__fields__ if f not in deferred]
+
+    # 用查询返回的一行(dict或(字段名, 值)序列)构造对象，并记下没有查询的字段和所在的分片
+    # 不经过__init__，构造出的对象没有修改过的字段
+    @classmethod
+    def _from_row(cls, row, deferred=(), shard=None):
+        obj = cls.__new__(cls)
+        dict.__init__(obj, row)
+        if deferred:
+            object.__setattr__(obj, '_deferred', deferred)
+        if shard is not None and shard != cls.__database__:
+            object.__setattr__(obj, '_shard', shard)
+        return obj
+
+    # 拼出findAll()、iter_all()共用的SELECT语句，返回(sql, args, 被延迟加载的字段)
+    @classmethod
+    def _select_sql(cls, where=None, args=None, **kw):
+        # __select__调用后格式为'select `%s`, %s from `%s`'，指定columns或defer时只查询部分字段
+        select_sql, deferred = cls._projection(kw.get("columns", None), kw.get("defer", None))
+        sql = [select_sql]
         # 如果有where参数就在sql语句中添加字符串where和参数where
         if where:
             sql.append("where")
             sql.append(where)
-        if args is None:  # 这个参数是在执行sql语句前嵌入到sql语句中的，如果为None则定义一个空的list
-            args = []
+        # 这个参数是在执行sql语句前嵌入到sql语句中的，复制一份避免修改调用者传入的list
+        args = list(args) if args else []
         # 如果有OrderBy参数就在sql语句中添加字符串OrderBy和参数OrderBy，但是OrderBy是在关键字参数中定义的
         orderBy = kw.get("orderBy", None)
+        # keyset(seek)分页：按(created_at, 主键)倒序排列，after取排在key之后的行，before取排在key之前的行
+        # 条件直接走idx_created_at索引定位，不需要像limit offset那样扫描并丢弃前面的行
+        after, before = kw.get("after", None), kw.get("before", None)
+        if after is not None or before is not None:
+            if orderBy:
+                raise ValueError("after/before不能与orderBy同时使用")
+            col, pk = kw.get("keyset", None) or ('created_at', cls.__primary_key__)
+            op, direction = ('<', 'desc') if after is not None else ('>', 'asc')
+            cond = "(`%s`%s? or (`%s`=? and `%s`%s?))" % (col, op, col, pk, op)
+            if where:
+                sql[1:] = ["where", "(%s) and %s" % (where, cond)]
+            else:
+                sql.extend(["where", cond])
+            key = after if after is not None else before
+            args.extend([key[0], key[0], key[1]])
+            # before按正序查出离key最近的几行，findAll()再把结果翻转回倒序
+            orderBy = "`%s` %s, `%s` %s" % (col, direction, pk, direction)
         if orderBy:
             sql.append("order by")
             sql.append(orderBy)
@@ -286,46 +1670,322 @@ class Model(dict, metaclass=ModelMetaclass):
             if isinstance(limit, int):
                 sql.append("?")
                 args.append(limit)
-            if isinstance(limit, tuple) and len(limit) == 2:
+            elif isinstance(limit, tuple) and len(limit) == 2:
                 sql.append("?,?")
                 args.extend(limit)  # extend() 函数用于在列表末尾一次性追加另一个序列中的多个值（用新列表扩展原来的列表）。
             else:
                 raise ValueError("错误的limit值：%s" % limit)
-        rs = await select(" ".join(sql), args)
-        return [cls(**r) for r in rs]
+        return " ".join(sql), args, deferred
+
+    # 开启了__query_cache__时先查query_cache；cache=False或在事务中时直接查询数据库
+    # database默认是__database__，分片的Model传入分片的数据库名
+    @classmethod
+    async def _cached_select(cls, sql, args, size=None, tuples=False, cache=True, database=None):
+        database = database or cls.__database__
+        if not (cache and cls.__query_cache__) or in_transaction(database):
+            return await select(sql, args, size, cls.__coalesce__, tuples, database)
+        key = (sql, tuple(args or ()), size, tuples, database)
+        rs = query_cache.get(cls.__table__, key)
+        if rs is None:
+            version = query_cache.versions[cls.__table__]
+            # 只和同一个版本下开始的查询合并，见select()的generation参数
+            rs = await select(sql, args, size, cls.__coalesce__, tuples, database, generation=version,
+                              primary=_fill_from_primary(cls.__table__, database))
+            query_cache.put(cls.__table__, key, rs, version)
+        return rs
+
+    # findAll() - 根据WHERE条件查找
+    # 关键字参数：orderBy, limit；keyset分页时用after=(created_at, id)或before=(created_at, id)代替offset
+    # columns=[...]只查询指定字段，defer=[...]不查询指定字段，未查询的字段可以之后用await obj.load()加载
+    # cache=False时不使用查询缓存
+    # 分片的Model：where以"分片键=?"开头或传入shard=分片键的值时只查一个分片，否则查询所有分片并按orderBy合并
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        rs, deferred, database = await cls._find_rows(where, args, kw)
+        names = cls._column_names(deferred)
+        return [cls._from_row(zip(names, r), deferred, database) for r in rs]
+
+    # findRecords() - 与findAll()参数相同，但返回__record__(紧凑的只读Record)而不是Model实例
+    # 适合只用来展示的列表，占用内存更少，构造更快；Record不能save()/update()/remove()
+    @classmethod
+    async def findRecords(cls, where=None, args=None, **kw):
+        rs, deferred, _ = await cls._find_rows(where, args, kw)
+        R = cls.__record__
+        if deferred:
+            names = cls._column_names(deferred)
+            return [R.from_pairs(zip(names, r)) for r in rs]
+        # 列顺序与Record构造函数的参数顺序一致，每行只需一次按位置构造
+        return [R(*r) for r in rs]
+
+    # batchFind() - 与find()相同，但同一轮事件循环里的多次调用会合并成一条in查询
+    # 例如 await asyncio.gather(*[User.batchFind(c.user_id) for c in comments]) 只查询一次
+    @classmethod
+    async def batchFind(cls, pk):
+        if cls._in_transaction():
+            return await cls.find(pk)
+        pk = cls.__mappings__[cls.__primary_key__].to_key(pk)
+        rs = await _loader(cls, cls.__primary_key__).load(pk)
+        return cls._from_row(zip(cls._column_names(), rs[0])) if rs else None
+
+    # batchFindAll() - 返回column字段等于value的所有对象，同一轮事件循环里的多次调用合并成一条in查询
+    # 例如为一页博客取评论：await asyncio.gather(*[Comment.batchFindAll('blog_id', b.id) for b in blogs])
+    @classmethod
+    async def batchFindAll(cls, column, value, orderBy=None):
+        if column not in cls.__mappings__:
+            raise ValueError('unknown field: %s' % column)
+        if cls._in_transaction():
+            return await cls.findAll('`%s`=?' % column, [value], orderBy=orderBy)
+        value = cls.__mappings__[column].to_key(value)
+        names = cls._column_names()
+        return [cls._from_row(zip(names, r)) for r in await _loader(cls, column, orderBy).load(value)]
+
+    # iter_all() - 与findAll()参数相同，但用服务端游标逐批读取，每次产出一个最多batch个对象的list
+    # 整个结果集不会一次性载入内存，适合导出、遍历大表
+    # 注意迭代期间会一直占用一个连接，应尽快消费完
+    # 分片的Model不能只查一个分片时依次遍历各分片，orderBy只在每个分片内有效
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch=100, **kw):
+        sql, args, deferred = cls._select_sql(where, args, **kw)
+        database = cls._route(where, args, kw)
+        for database in [database] if database is not None else cls._shards():
+            async for rs in select_iter(sql, args, batch, database):
+                yield [cls._from_row(r, deferred, database) for r in rs]
 
     # findNumber() - 根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL。
+    # 分片的Model查询所有分片时把各分片的结果相加，所以只支持count()和sum()
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, cache=True, **kw):
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append("where")
             sql.append(where)
-        rs = await select(" ".join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        database = cls._route(where, args, kw)
+        if database is not None:
+            rs = await cls._cached_select(" ".join(sql), args, 1, cache=cache, database=database)
+            if len(rs) == 0:
+                return None
+            return rs[0]['_num_']
+        if not selectField.lower().startswith(('count(', 'sum(')):
+            raise ValueError('%s cannot be computed across shards' % selectField)
+        parts = await gather(*[cls._cached_select(" ".join(sql), args, 1, cache=cache, database=d) for d in cls._shards()])
+        nums = [rs[0]['_num_'] for rs in parts if rs and rs[0]['_num_'] is not None]
+        return sum(nums) if nums else None
+
+    # create_table_sql() - 根据字段和索引的定义生成建表语句
+    @classmethod
+    def create_table_sql(cls):
+        lines = ['`%s` %s not null' % (k, f.column_type) for k, f in cls.__mappings__.items()]
+        lines.extend(idx.ddl() for idx in cls.__indexes__)
+        lines.append('primary key (`%s`)' % cls.__primary_key__)
+        return 'create table `%s` (\n    %s\n) engine=innodb default charset=utf8;' % (cls.__table__, ',\n    '.join(lines))
+
+    # count() - 返回满足where条件的行数，结果由全局的counts维护，不会每次都查询数据库
+    @classmethod
+    async def count(cls, where=None, args=None):
+        return await counts.get(cls, where, args)
+
+    # 按所在的数据库把对象分组，返回数据库名 -> 对象的list
+    @classmethod
+    def _by_shard(cls, objects):
+        shards = collections.OrderedDict()
+        for obj in objects:
+            shards.setdefault(obj._db(), []).append(obj)
+        return shards
+
+    # 每batch_size个对象拼成一条多行INSERT，返回[(sql, args), ...]
+    @classmethod
+    def _insert_statements(cls, objects, batch_size):
+        # __insert__形如'insert into `t` (...) values (?, ?)'，沿用它的列顺序，只重复values部分
+        head, row = cls.__insert__.rsplit(' values ', 1)
+        statements = []
+        for i in range(0, len(objects), batch_size):
+            batch = objects[i:i + batch_size]
+            args = []
+            for obj in batch:
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            statements.append(('%s values %s' % (head, ', '.join([row] * len(batch))), args))
+        return statements
+
+    # 批量写操作之后让行缓存和查询缓存失效，pks为None时清空整个行缓存
+    # 在事务中时提交后再失效一次，防止提交前被其他请求读到旧数据写回缓存
+    @classmethod
+    def _invalidate_rows(cls, database, pks=None):
+        cache, table = cls.__cache__, cls.__table__
+        def invalidate():
+            if cache is not None:
+                if pks is None:
+                    cache.clear()
+                else:
+                    for pk in pks:
+                        cache.invalidate(pk)
+            query_cache.bump(table)
+            _invalidated_at[table] = time.monotonic()
+        invalidate()
+        if in_transaction(database):
+            after_commit(invalidate, database)
+
+    # save_many() - 批量插入，每batch_size个对象拼成一条多行INSERT，所有批次在一个事务里提交
+    # 分片的Model每个分片各有一个事务，分片之间不是原子的
+    @classmethod
+    async def save_many(cls, objects, batch_size=500):
+        objects = list(objects)
+        if not objects:
+            return 0
+        rows = 0
+        for database, shard_objects in cls._by_shard(objects).items():
+            n = await execute_batch(cls._insert_statements(shard_objects, batch_size), database)
+            after_commit(lambda n=n: counts.adjust(cls.__table__, n), database)
+            rows += n
+        for obj in objects:
+            object.__setattr__(obj, '_dirty', None)
+            obj._invalidate()
+        if rows != len(objects):
+            logging.warn('failed to insert all records: affected rows: %s of %s' % (rows, len(objects)))
+        return rows
+
+    # upsert_many() - 批量插入，key字段(默认主键)冲突的行改为更新update中的字段(默认除key外的全部字段)
+    # 每batch_size个对象一条语句，所有批次在一个事务里提交；返回数据库报告的受影响行数
+    # MySQL在任何一个唯一索引冲突时都会更新，SQLite只看key字段，key上要有主键或唯一索引
+    # key不是主键时，冲突的行保留原来的主键，对象上的主键不会变成它
+    @classmethod
+    async def upsert_many(cls, objects, update=None, key=None, batch_size=500):
+        objects = list(objects)
+        if not objects:
+            return 0
+        key = key or cls.__primary_key__
+        columns = [f for f in cls.__fields__ if f != key] if update is None else list(update)
+        unknown = (set(columns) | {key}) - set(cls.__mappings__)
+        if unknown:
+            raise ValueError('unknown field: %s' % ', '.join(sorted(unknown)))
+        rows = 0
+        for database, shard_objects in cls._by_shard(objects).items():
+            driver = _database(database).driver
+            statements = [(driver.upsert(sql, key, columns), args) for sql, args in cls._insert_statements(shard_objects, batch_size)]
+            rows += await execute_batch(statements, database)
+            # 不知道插入了几行、更新了几行
+            after_commit(lambda: counts.forget(cls.__table__), database)
+            cls._invalidate_rows(database, [obj.getValue(cls.__primary_key__) for obj in shard_objects] if key == cls.__primary_key__ else None)
+        for obj in objects:
+            object.__setattr__(obj, '_dirty', None)
+        return rows
+
+    # delete_where() - 用一条DELETE删除满足where条件的所有行，返回删除的行数
+    # 分片的Model：where以"分片键=?"开头或传入shard=分片键的值时只在一个分片上执行，否则在每个分片上执行
+    # 为了防止误删整张表，where不能为空，确实要删除全部时写'1=1'
+    @classmethod
+    async def delete_where(cls, where, args=None, **kw):
+        if not where:
+            raise ValueError('delete_where() requires a where clause')
+        sql = 'delete from `%s` where %s' % (cls.__table__, where)
+        database = cls._route(where, args, kw)
+        rows = 0
+        for database in [database] if database is not None else cls._shards():
+            n = await execute(sql, args, database=database)
+            after_commit(lambda n=n: counts.adjust(cls.__table__, -n), database)
+            cls._invalidate_rows(database)
+            rows += n
+        return rows
+
+    # delete_many() - 按主键批量删除，每batch_size个主键一条DELETE，在一个事务里提交，返回删除的行数
+    @classmethod
+    async def delete_many(cls, pks, batch_size=500):
+        to_key = cls.__mappings__[cls.__primary_key__].to_key
+        pks = [to_key(pk) for pk in pks]
+        if not pks:
+            return 0
+        rows = 0
+        # 主键不是分片键，不知道在哪个分片上，每个分片都要执行
+        for database in cls._shards():
+            statements = [('delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(pks[i:i + batch_size]))),
+                           pks[i:i + batch_size]) for i in range(0, len(pks), batch_size)]
+            n = await execute_batch(statements, database)
+            after_commit(lambda n=n: counts.adjust(cls.__table__, -n), database)
+            cls._invalidate_rows(database, pks)
+            rows += n
+        return rows
 
 	# ===============往Model类添加实例方法，就可以让所有子类调用实例方法===================
 
+    # 这一行所在的数据库：分片的Model按分片键的值选择分片，分片键没有加载时用读出它的分片
+    def _db(self):
+        if self._ring() is None:
+            return self.__database__
+        if self.__shard_key__ not in self._deferred:
+            return self.database_for(self.getValueOrDefault(self.__shard_key__))
+        if self._shard is None:
+            raise ValueError("shard key '%s' is not loaded" % self.__shard_key__)
+        return self._shard
+
+    # 写操作之后让该行的缓存和该表的查询缓存失效
+    def _invalidate(self):
+        self._invalidate_rows(self._db(), [self.getValue(self.__primary_key__)])
+
     # save、update、remove这三个方法需要管理员权限才能操作，所以不定义为类方法，需要创建实例之后才能调用
+    # 开启了__write_buffer__且不在事务中时，和其他save()合并写入，返回时这一行已经提交
     async def save(self):
+        database = self._db()
+        if self.__write_buffer__ and not in_transaction(database):
+            for k in self.__mappings__:
+                self.getValueOrDefault(k)  # 主键、created_at等默认值在调用时生成，而不是写入时
+            await _write_buffer(self.__class__, database).add(self)
+            return
+        await self._insert()
+
+    async def _insert(self):
         args = list(map(self.getValueOrDefault, self.__fields__))  # 将除主键外的属性名添加到args这个列表中
         args.append(self.getValueOrDefault(self.__primary_key__))  # 再把主键添加到这个列表的最后
-        rows = await execute(self.__insert__, args)
+        database = self._db()
+        rows = await execute(self.__insert__, args, database=database)
+        object.__setattr__(self, '_dirty', None)
+        after_commit(lambda: counts.adjust(self.__table__, rows), database)
+        self._invalidate()  # 清掉可能存在的负缓存
         if rows != 1:  # 插入纪录受影响的行数应该为1，如果不是1 那就错了
             logging.warn("无法插入纪录，受影响的行：%s" % rows)
 
+    # upsert() - 插入这一行，key字段冲突时改为更新，只执行一条语句，参数见upsert_many()
+    async def upsert(self, update=None, key=None):
+        return await self.upsert_many([self], update, key)
+
+    # load() - 加载find()/findAll()时通过columns或defer跳过的字段，不传names时加载全部
+    async def load(self, *names):
+        names = [n for n in (names or self._deferred) if n in self._deferred]
+        if names:
+            sql = 'select %s from `%s` where `%s`=?' % (', '.join('`%s`' % n for n in names), self.__table__, self.__primary_key__)
+            rs = await select(sql, [self.getValue(self.__primary_key__)], 1, self.__coalesce__, database=self._db())
+            if rs:
+                dict.update(self, rs[0])  # Model.update()是写数据库的方法，这里要用dict的update
+            object.__setattr__(self, '_deferred', tuple(n for n in self._deferred if n not in names))
+        return self
+
+    # update()只写加载之后修改过的字段，没有修改时不访问数据库
+    # 没有加载(columns/defer跳过)且没有赋值的字段不会被写成NULL
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        dirty = self._dirty
+        fields = [f for f in self.__fields__ if f in dirty] if dirty else []
+        if not fields:
+            logging.debug('nothing to update for %s: %s' % (self.__table__, self.getValue(self.__primary_key__)))
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:
+            sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join('`%s`=?' % f for f in fields), self.__primary_key__)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        database = self._db()
+        rows = await execute(sql, args, database=database)
+        object.__setattr__(self, '_dirty', None)
+        after_commit(lambda: counts.adjust(self.__table__, 0), database)  # 总数不变，但带where的计数可能变了
+        self._invalidate()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        database = self._db()
+        rows = await execute(self.__delete__, args, database=database)
+        after_commit(lambda: counts.adjust(self.__table__, -rows), database)
+        self._invalidate()
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'milletluo'
+
+'''
+orm的测试，使用SQLite驱动，不需要MySQL服务器
+在www目录下执行：python3 -m unittest orm_test
+'''
+
+import asyncio, os, shutil, sqlite3, tempfile, unittest
+import orm
+from models import User, Blog, Comment
+
+try:
+    import handlers
+except ImportError:  # handlers依赖aiohttp
+    handlers = None
+
+class SQLiteTestCase(unittest.IsolatedAsyncioTestCase):
+
+    # 分片数，0表示comments使用默认数据库
+    shards = 0
+    # 默认数据库的只读副本数；副本是单独的文件，不会自动同步，相当于落后于主库的副本
+    replicas = 0
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.mkdtemp()
+        # orm的状态是模块级的，每个测试都从空的状态开始
+        orm._databases.clear()
+        orm._shard_rings.clear()
+        orm._write_buffers.clear()
+        orm._loaders.clear()
+        orm.counts.clear()
+        orm.query_cache.clear()
+        for cls in (User, Blog, Comment):
+            if cls.__cache__ is not None:
+                cls.__cache__.clear()
+        databases = {}
+        if self.shards:
+            databases['comments'] = {'shards': [{'path': self.path('comments%d' % i)} for i in range(self.shards)]}
+        replicas = [{'path': self.path('replica%d' % i)} for i in range(self.replicas)]
+        await orm.create_pool(None, driver='sqlite', path=self.path('awesome'), replicas=replicas, databases=databases)
+        await orm.create_tables(User, Blog, Comment)
+
+    async def asyncTearDown(self):
+        await orm.flush_writes()
+        for db in orm._databases.values():
+            for pool in db.pools():
+                pool.pool.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.dir, name + '.db')
+
+    async def create_blog(self, name='blog', created_at=None):
+        blog = Blog(user_id=1, user_name='u', user_image='i', name=name, summary='s', content='c')
+        if created_at is not None:
+            blog.created_at = created_at
+        await blog.save()
+        return blog
+
+    def comment(self, blog, created_at, **kw):
+        return Comment(blog_id=blog.id, user_id=1, user_name='u', user_image='i', content='c%s' % created_at, created_at=created_at, **kw)
+
+    # 在后台开始执行coro，其中第一条SELECT读到结果后先不返回，直到调用返回的release()
+    # 用来模拟一个在写操作之前开始、之后才结束的慢查询
+    async def held_query(self, coro):
+        select, gate = orm._select, asyncio.Event()
+        async def held(*args, **kw):
+            rs = await select(*args, **kw)
+            await gate.wait()
+            return rs
+        orm._select = held
+        try:
+            task = asyncio.ensure_future(coro)
+            await asyncio.sleep(0.05)
+        finally:
+            orm._select = select
+        def release():
+            gate.set()
+            return task
+        return release
+
+class ModelTest(SQLiteTestCase):
+
+    async def test_save_find_update(self):
+        user = User(email='a@example.com', passwd='p', admin=False, name='a', image='i')
+        await user.save()
+        self.assertIsNone(user._dirty)
+        found = await User.find(user.id)
+        self.assertEqual(found.email, 'a@example.com')
+        self.assertIsNone(found._dirty)
+        # 没有修改时update()不访问数据库
+        with orm.query_budget(0):
+            await found.update()
+        found.name = 'b'
+        self.assertEqual(found._dirty, {'name'})
+        with orm.query_budget(1) as counter:
+            await found.update()
+        self.assertEqual(list(counter.templates), ['update `users` set `name`=? where `id`=?'])
+        self.assertIsNone(found._dirty)
+        self.assertEqual((await User.find(user.id)).name, 'b')
+
+    async def test_deferred_load(self):
+        blog = await self.create_blog()
+        found = await Blog.find(blog.id, defer=['content'])
+        with self.assertRaises(AttributeError):
+            found.content
+        await found.load()
+        self.assertEqual(found.content, 'c')
+
+    async def test_transaction_rollback(self):
+        await orm.counts.seed(Blog)
+        with self.assertRaises(RuntimeError):
+            async with orm.transaction():
+                blog = await self.create_blog()
+                self.assertTrue(orm.in_transaction())
+                raise RuntimeError('rollback')
+        self.assertIsNone(await Blog.find(blog.id))
+        self.assertEqual(await Blog.count(), 0)
+        async with orm.transaction():
+            blog = await self.create_blog()
+        self.assertIsNotNone(await Blog.find(blog.id))
+        self.assertEqual(await Blog.count(), 1)
+
+    async def test_keyset_pagination(self):
+        blogs = [await self.create_blog('b%d' % i, 1000.0 + i) for i in range(5)]
+        names = lambda rs: [b.name for b in rs]
+        first = await Blog.findAll(orderBy='created_at desc, id desc', limit=2)
+        self.assertEqual(names(first), ['b4', 'b3'])
+        nxt = await Blog.findAll(after=(first[-1].created_at, first[-1].id), limit=2)
+        self.assertEqual(names(nxt), ['b2', 'b1'])
+        prev = await Blog.findAll(before=(nxt[0].created_at, nxt[0].id), limit=2)
+        self.assertEqual(names(prev), ['b4', 'b3'])
+        self.assertEqual(names(await Blog.findAll(after=(blogs[0].created_at, blogs[0].id), limit=2)), [])
+
+    async def test_write_buffer_retries_row_by_row(self):
+        blog = await self.create_blog()
+        first = self.comment(blog, 1000.0)
+        await first.save()
+        dup = self.comment(blog, 1001.0, id=first.id)
+        ok = self.comment(blog, 1002.0)
+        results = await asyncio.gather(dup.save(), ok.save(), return_exceptions=True)
+        self.assertIsInstance(results[0], sqlite3.IntegrityError)
+        self.assertIsNone(results[1])
+        self.assertEqual(await Comment.findNumber('count(id)', cache=False), 2)
+        self.assertIsNotNone(await Comment.find(ok.id))
+
+    async def test_write_buffer_batches(self):
+        blog = await self.create_blog()
+        comments = [self.comment(blog, 1000.0 + i) for i in range(20)]
+        await asyncio.gather(*[c.save() for c in comments])
+        stats = orm.metrics()['write_buffers']
+        self.assertEqual(sum(s['rows'] for s in stats), 20)
+        self.assertEqual(sum(s['flushes'] for s in stats), 1)
+        self.assertEqual(len(await Comment.findAll('blog_id=?', [blog.id])), 20)
+
+    async def test_batched_statements_counted(self):
+        blogs = [await self.create_blog('b%d' % i) for i in range(3)]
+        # 三次batchFind()合并成一条in查询，计入调用者
+        with orm.query_budget(1) as counter:
+            found = await asyncio.gather(*[Blog.batchFind(b.id) for b in blogs])
+        self.assertEqual([b.name for b in found], ['b0', 'b1', 'b2'])
+        self.assertEqual(counter.count, 1)
+        # 写缓冲合并的插入也计入调用者
+        with orm.query_budget(1) as counter:
+            await asyncio.gather(*[self.comment(blogs[0], 1000.0 + i).save() for i in range(3)])
+        self.assertEqual(counter.count, 1)
+
+    async def test_row_cache_not_filled_by_read_started_before_write(self):
+        blog = await self.create_blog('old')
+        release = await self.held_query(Blog.find(blog.id))
+        blog.name = 'new'
+        await blog.update()
+        # 失效之后的find()不能合并到失效之前开始的查询上
+        second = asyncio.ensure_future(Blog.find(blog.id))
+        await asyncio.sleep(0.05)
+        self.assertEqual((await release()).name, 'old')
+        self.assertEqual((await second).name, 'new')
+        self.assertEqual((await Blog.find(blog.id)).name, 'new')
+
+    async def test_query_cache_not_filled_by_read_started_before_write(self):
+        blog = await self.create_blog('v1')
+        query = lambda: Blog.findAll(orderBy='created_at desc', limit=(0, 10))
+        release = await self.held_query(query())
+        blog.name = 'v2'
+        await blog.update()
+        second = asyncio.ensure_future(query())
+        await asyncio.sleep(0.05)
+        self.assertEqual((await release())[0].name, 'v1')
+        self.assertEqual((await second)[0].name, 'v2')
+        self.assertEqual((await query())[0].name, 'v2')
+
+    async def test_statement_templates_collapse_lists(self):
+        orm.query_stats.clear()
+        blogs = [await self.create_blog('b%d' % i) for i in range(3)]
+        await Blog.delete_many([blogs[0].id])
+        await Blog.delete_many([b.id for b in blogs[1:]])
+        await Blog.save_many([Blog(user_id=1, user_name='u', user_image='i', name='n', summary='s', content='c') for _ in range(2)])
+        await Blog.save_many([Blog(user_id=1, user_name='u', user_image='i', name='n', summary='s', content='c') for _ in range(3)])
+        deletes = [sql for sql in orm.query_stats if sql.startswith('delete')]
+        self.assertEqual(deletes, ['delete from `blogs` where `id` in (...)'])
+        self.assertEqual(orm.query_stats[deletes[0]].time.count, 2)
+        inserts = [sql for sql in orm.query_stats if sql.startswith('insert')]
+        self.assertEqual(len(inserts), 2)  # 单行的save()和多行的save_many()
+        self.assertEqual(sum(orm.query_stats[sql].time.count for sql in inserts), 5)
+        with self.assertRaises(ValueError):
+            orm.query_report('buckets')
+        self.assertTrue(orm.query_report('p95'))
+
+    def test_unknown_fields_rejected(self):
+        with self.assertRaises(ValueError):
+            class BadIndex(orm.Model):
+                id = orm.IdField(primary_key=True)
+                __indexes__ = [orm.Index('missing')]
+        with self.assertRaises(ValueError):
+            class BadShardKey(orm.Model):
+                id = orm.IdField(primary_key=True)
+                __shard_key__ = 'missing'
+
+class ReplicaTest(SQLiteTestCase):
+
+    replicas = 1
+
+    # 把主库当前的数据复制到副本
+    def sync_replica(self):
+        src, dst = sqlite3.connect(self.path('awesome')), sqlite3.connect(self.path('replica0'))
+        src.backup(dst)
+        src.close()
+        dst.close()
+
+    async def test_cache_filled_from_primary_after_write(self):
+        # 写操作在另一个请求(context)里执行，本请求的read-your-writes不起作用
+        orm._written_at.set(None)  # asyncSetUp里建表也算本请求的写入
+        user = User(email='a@example.com', passwd='p', admin=True, name='a', image='i')
+        await asyncio.ensure_future(user.save())
+        self.sync_replica()
+        user.admin = False
+        await asyncio.ensure_future(user.update())
+        self.assertFalse((await User.find(user.id)).admin)
+        self.assertFalse((await User.find(user.id)).admin)  # 缓存的是主库的新数据
+        # 没有最近的写操作时仍然读副本
+        orm._invalidated_at.clear()
+        User.__cache__.clear()
+        self.assertTrue((await User.find(user.id)).admin)
+
+class ShardTest(SQLiteTestCase):
+
+    shards = 2
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.blogs = [await self.create_blog('b%d' % i) for i in range(6)]
+        comments = [self.comment(self.blogs[i % 6], 1000.0 + i) for i in range(30)]
+        await Comment.save_many(comments)
+
+    def shard_counts(self):
+        return [sqlite3.connect(self.path('comments%d' % i)).execute('select count(*) from comments').fetchone()[0] for i in range(self.shards)]
+
+    async def test_rows_distributed(self):
+        counts = self.shard_counts()
+        self.assertEqual(sum(counts), 30)
+        self.assertTrue(all(counts))
+        self.assertEqual(await Comment.count(), 30)
+
+    async def test_routed_query(self):
+        blog = self.blogs[0]
+        with orm.query_budget(1):
+            rs = await Comment.findAll('blog_id=?', [blog.id], orderBy='created_at desc', cache=False)
+        self.assertEqual([c.created_at for c in rs], [1024.0, 1018.0, 1012.0, 1006.0, 1000.0])
+        self.assertTrue(all(c._db() == Comment.database_for(blog.id) for c in rs))
+
+    async def test_scatter_merge(self):
+        rs = await Comment.findRecords(orderBy='created_at desc', limit=(5, 5))
+        self.assertEqual([r.created_at for r in rs], [1024.0, 1023.0, 1022.0, 1021.0, 1020.0])
+        rs = await Comment.findRecords(after=(1020.0, 0), limit=3)
+        self.assertEqual([r.created_at for r in rs], [1019.0, 1018.0, 1017.0])
+        rs = await Comment.findRecords(before=(1020.0, 0), limit=3)
+        self.assertEqual([r.created_at for r in rs], [1022.0, 1021.0, 1020.0])
+        with self.assertRaises(ValueError):
+            await Comment.findAll(orderBy='length(content)')
+
+    async def test_find_and_remove_across_shards(self):
+        comment = (await Comment.findAll('blog_id=?', [self.blogs[1].id]))[0]
+        found = await Comment.find(comment.id, columns=['content'])
+        self.assertEqual(found._db(), Comment.database_for(self.blogs[1].id))
+        await found.remove()
+        self.assertIsNone(await Comment.find(comment.id))
+        self.assertEqual(await Comment.count(), 29)
+
+    async def test_delete_where(self):
+        self.assertEqual(await Comment.delete_where('blog_id=?', [self.blogs[2].id]), 5)
+        self.assertEqual(await Comment.delete_where('user_id=?', [1]), 25)
+        self.assertEqual(sum(self.shard_counts()), 0)
+        self.assertEqual(await Comment.count(), 0)
+
+@unittest.skipIf(handlers is None, 'aiohttp is not installed')
+class HandlerTest(SQLiteTestCase):
+
+    async def test_user2cookie(self):
+        user = User(email='a@example.com', passwd='p', admin=False, name='a', image='i')
+        await user.save()
+        cookie = handlers.user2cookie(user, 86400)
+        self.assertTrue(cookie.startswith('%s-' % user.id))
+        self.assertEqual((await handlers.cookie2user(cookie)).id, user.id)
+
+    async def test_get_blog_query_budget(self):
+        blog = await self.create_blog()
+        await Comment.save_many([self.comment(blog, 1000.0 + i) for i in range(5)])
+        request = type('Request', (), {'__user__': None})()
+        # 博客和评论各一条查询，评论数不影响查询数
+        with orm.query_budget(2, repeated=1):
+            r = await handlers.get_blog(str(blog.id), request)
+        self.assertEqual(len(r['comments']), 5)
+
+if __name__ == '__main__':
+    unittest.main()
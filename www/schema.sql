@@ -9,12 +9,13 @@ use awesome;
 grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
 
 create table users(
-    `id` varchar(50) not null,
+    `id` bigint unsigned not null,
     `email` varchar(50) not null,
     `passwd` varchar(50) not null,
     `admin` bool not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
+    `legacy_id` varchar(50) not null default '',
     `created_at` real not null,
     unique key `idx_email` (`email`),
     key `idx_created_at` (`created_at`),
@@ -22,8 +23,8 @@ create table users(
 )engine=innodb default charset = utf8;
 
 create table blogs (
-    `id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint unsigned not null,
+    `user_id` bigint unsigned not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `name` varchar(50) not null,
@@ -35,13 +36,14 @@ create table blogs (
 ) engine=innodb default charset=utf8;
 
 create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+    `id` bigint unsigned not null,
+    `blog_id` bigint unsigned not null,
+    `user_id` bigint unsigned not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
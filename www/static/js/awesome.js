@@ -124,6 +124,13 @@ function gotoPage(i) {
     location.assign('?' + $.param(r));
 }
 
+function gotoCursor(c) {
+    var r = parseQueryString();
+    delete r.page;
+    r.cursor = c;
+    location.assign('?' + $.param(r));
+}
+
 function refresh() {
     var
         t = new Date().getTime(),
@@ -366,6 +373,20 @@ if (typeof(Vue)!=='undefined') {
                 '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
             '</ul>'
     });
+
+    Vue.component('cursor-pagination', {
+        template: '<ul class="uk-pagination">' +
+                '<li v-if="! has_previous" class="uk-disabled"><span><i class="uk-icon-angle-double-left"></i></span></li>' +
+                '<li v-if="has_previous"><a v-on="click: gotoCursor(prev_cursor)" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
+                '<li v-if="! has_next" class="uk-disabled"><span><i class="uk-icon-angle-double-right"></i></span></li>' +
+                '<li v-if="has_next"><a v-on="click: gotoCursor(next_cursor)" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
+            '</ul>',
+        methods: {
+            gotoCursor: function (c) {
+                gotoCursor(c);
+            }
+        }
+    });
 }
 
 function redirect(url) {